@@ -1,7 +1,16 @@
+import functools
 import hashlib
 import secrets
 import json
-
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+import codec
 import ecc
 
 ################################################################
@@ -28,6 +37,17 @@ def get_difficulty(height: int) -> int:
 
     return start_difficulty + (height // 100000) # difficulty of mining increases every 100000 blocks
 
+def get_target(difficulty: int) -> bytes:
+    # Highest block hash that has `difficulty` leading zero hex digits
+    return ((1 << (256 - 4 * difficulty)) - 1).to_bytes(32, "big")
+
+def meets_target(block_hash: bytes, difficulty: int) -> bool:
+    if difficulty > 2 * len(block_hash):
+        # Heights so large that no hash has enough zero digits (get_target can't express it)
+        return False
+
+    return block_hash <= get_target(difficulty)
+
 def get_block_reward(height: int) -> int:
     start_reward = 50 * 10**9
 
@@ -50,6 +70,15 @@ class Signature:
             "s": self.content.s
         })
 
+    def serialize_binary(self) -> bytes:
+        # 64 bytes: r | s
+        return self.content.r.to_bytes(32, "big") + self.content.s.to_bytes(32, "big")
+
+    @classmethod
+    def _read_binary(cls, view: memoryview, offset: int) -> tuple:
+        data, offset = codec.read_bytes(view, offset, 64)
+        return (cls(r = int.from_bytes(data[:32], "big"), s = int.from_bytes(data[32:], "big")), offset)
+
     def __repr__(self) -> str:
         return self.content.__repr__()
 
@@ -124,7 +153,16 @@ class PublicKey:
         else:
             self.content = content
 
-        self.address = address_generator(self.content)
+        self._address = None
+
+    @property
+    def address(self) -> str:
+        # Computed on first use; keys decoded through parse_sec() are shared, so
+        # a frequent sender's address is derived only once
+        if self._address is None:
+            self._address = address_generator(self.content)
+
+        return self._address
 
     def verify(self, message: bytes, signature: Signature) -> bool:
         z = int.from_bytes(hash256(message), "big")
@@ -133,10 +171,23 @@ class PublicKey:
 
     def serialize(self) -> str:
         return json.dumps({
-            "x": self.content.x.num,
-            "y": self.content.y.num,
+            "sec": self.serialize_binary().hex()
         })
 
+    def serialize_binary(self) -> bytes:
+        # 33 byte compressed SEC encoding
+        return self.content.sec(compressed=True)
+
+    @classmethod
+    def parse_sec(cls, data: bytes):
+        # Decoded keys are cached, so callers must not modify the returned object
+        return _public_key_from_sec(bytes(data))
+
+    @classmethod
+    def _read_binary(cls, view: memoryview, offset: int) -> tuple:
+        data, offset = codec.read_bytes(view, offset, 33)
+        return (cls.parse_sec(data), offset)
+
     def __eq__(self, other) -> bool:
         return self.content == other.content
 
@@ -154,6 +205,10 @@ class PublicKey:
             raise ValueError("Cannot parse JSON serialization")
 
         try:
+            if "sec" in data:
+                return cls.parse_sec(bytes.fromhex(data["sec"]))
+
+            # Uncompressed serialization used by older nodes
             return cls(
                 privkey = None,
                 content = ecc.S256Point(
@@ -164,22 +219,112 @@ class PublicKey:
         except KeyError:
             raise ValueError("This is not valid PublicKey JSON serialization")
 
+PUBLIC_KEY_CACHE_SIZE = 10000
+
+@functools.lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def _public_key_from_sec(data: bytes) -> PublicKey:
+    return PublicKey(privkey = None, content = ecc.S256Point.parse_sec(data))
+
+def batch_verify(items: list) -> list:
+    # items: [(PublicKey, message, Signature), ...]
+    # Returns indices of the items whose signature is invalid (empty if all pass)
+    return ecc.batch_verify([
+        (pubkey.content, int.from_bytes(hash256(message), "big"), signature.content)
+        for pubkey, message, signature in items
+    ])
+
+################################################################
+# SIGNATURE VERIFICATION CACHE
+################################################################
+
+class SignatureCache:
+    # Bounded LRU set of (tx hash, signature) pairs that already passed verification
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(tx_hash: bytes, signature: Signature) -> tuple:
+        return (tx_hash, signature.content.r, signature.content.s)
+
+    def contains(self, key: tuple) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            return False
+
+    def add(self, key: tuple):
+        with self._lock:
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+SIGNATURE_CACHE = SignatureCache()
+
 ################################################################
 # ACTUAL BLOCKCHAIN
 ################################################################
 
 class Transaction:
-    def __init__(self, sender: PublicKey, recipient: str, amount: int, prev_hash: bytes, signature: Signature = None):
+    __slots__ = ("sender", "recipient", "amount", "prev_hash", "signature", "_message", "_hash")
+
+    # Fields committed to by the signing message and the hash; they can be set only once
+    _immutable_fields = ("sender", "recipient", "amount", "prev_hash")
+
+    def __init__(self, sender: PublicKey, recipient: str, amount: int, prev_hash: bytes, signature: Signature = None, verify: bool = True):
         self.sender = sender
         self.recipient = recipient
         self.amount = amount       # 1 means 1/000000000 of FUZC
         self.prev_hash = prev_hash
+        self.signature = signature
 
-        if signature is not None:
+        self._message = self._build_message()
+        self._hash = hash256(self._message)
+
+        if signature is not None and verify:
             if not self.verify():
                 raise ValueError("Invalid signature")
 
-        self.signature = signature
+    def __setattr__(self, name, value):
+        if name in self._immutable_fields and hasattr(self, name):
+            raise AttributeError(f"Transaction field '{name}' cannot be modified")
+
+        object.__setattr__(self, name, value)
+
+    def _build_message(self) -> bytes:
+        m_sender = self.sender.content.x.num.to_bytes(32, "big") + self.sender.content.y.num.to_bytes(32, "big") # 64 bytes
+        m_recipient = self.recipient.encode("ascii") # 50 bytes
+        m_amount = self.amount.to_bytes((self.amount.bit_length() + 7) // 8, "big") # variable size
+
+        return self.prev_hash + m_sender + m_recipient + m_amount
+
+    def message(self) -> bytes:
+        return self._message
 
     def sign(self, privkey: PrivateKey):
         if self.signature is not None:
@@ -188,31 +333,25 @@ class Transaction:
         if PublicKey(privkey) != self.sender:
             raise ValueError("This private key does not belong to sender")
 
-        m_sender = self.sender.content.x.num.to_bytes(32, "big") + self.sender.content.y.num.to_bytes(32, "big") # 64 bytes
-        m_recipient = self.recipient.encode("ascii") # 50 bytes
-        m_amount = self.amount.to_bytes((self.amount.bit_length() + 7) // 8, "big") # variable size
-
-        m = self.prev_hash + m_sender + m_recipient + m_amount
-
-        self.signature = privkey.sign(m)
+        self.signature = privkey.sign(self.message())
 
     def verify(self) -> bool:
-        m_sender = self.sender.content.x.num.to_bytes(32, "big") + self.sender.content.y.num.to_bytes(32, "big") # 64 bytes
-        m_recipient = self.recipient.encode("ascii") # 50 bytes
-        m_amount = self.amount.to_bytes((self.amount.bit_length() + 7) // 8, "big") # variable size
+        if self.signature is None:
+            return False
 
-        m = self.prev_hash + m_sender + m_recipient + m_amount
+        key = SignatureCache.key(self.hash(), self.signature)
 
-        return self.sender.verify(m, self.signature)
+        if SIGNATURE_CACHE.contains(key):
+            return True
 
-    def hash(self) -> bytes:
-        m_sender = self.sender.content.x.num.to_bytes(32, "big") + self.sender.content.y.num.to_bytes(32, "big") # 64 bytes
-        m_recipient = self.recipient.encode("ascii") # 50 bytes
-        m_amount = self.amount.to_bytes((self.amount.bit_length() + 7) // 8, "big") # variable size
+        if not self.sender.verify(self.message(), self.signature):
+            return False
 
-        m = self.prev_hash + m_sender + m_recipient + m_amount
+        SIGNATURE_CACHE.add(key)
+        return True
 
-        return hash256(m)
+    def hash(self) -> bytes:
+        return self._hash
 
     def serialize(self) -> str:
         return json.dumps({
@@ -224,17 +363,79 @@ class Transaction:
             "hash": self.hash().hex()
         })
 
+    # Binary layout (after the version byte):
+    #   kind (1) = 0 | sender (33) | recipient (varint length + ascii) | amount (varint) | prev_hash (32) | signature (64)
+    BINARY_KIND = 0
+
+    def serialize_binary(self) -> bytes:
+        if self.signature is None:
+            raise ValueError("Cannot serialize unsigned transaction")
+
+        return (
+            bytes((codec.CODEC_VERSION, self.BINARY_KIND)) +
+            self.sender.serialize_binary() +
+            codec.encode_bytes(self.recipient.encode("ascii")) +
+            codec.encode_varint(self.amount) +
+            self.prev_hash +
+            self.signature.serialize_binary()
+        )
+
+    @classmethod
+    def parse_binary(cls, data, verify: bool = False):
+        view = memoryview(data)
+        tx, offset = Transaction._read_binary(view, 0, verify)
+
+        if offset != len(view):
+            raise ValueError("Trailing data after binary transaction")
+
+        if not isinstance(tx, cls):
+            raise ValueError(f"Binary serialization is not a {cls.__name__}")
+
+        return tx
+
+    @staticmethod
+    def _read_binary(view: memoryview, offset: int, verify: bool = False) -> tuple:
+        # Reads either kind of transaction
+        offset = codec.read_version(view, offset)
+        kind, offset = codec.read_bytes(view, offset, 1)
+
+        if kind[0] == CoinbaseTransaction.BINARY_KIND:
+            return CoinbaseTransaction._read_binary_body(view, offset)
+
+        if kind[0] != Transaction.BINARY_KIND:
+            raise ValueError(f"Unknown binary transaction kind {kind[0]}")
+
+        sender, offset = PublicKey._read_binary(view, offset)
+        recipient, offset = codec.decode_bytes(view, offset)
+        amount, offset = codec.decode_varint(view, offset)
+        prev_hash, offset = codec.read_bytes(view, offset, 32)
+        signature, offset = Signature._read_binary(view, offset)
+
+        tx = Transaction(
+            sender = sender,
+            recipient = str(recipient, "ascii"),
+            amount = amount,
+            prev_hash = bytes(prev_hash),
+            signature = signature,
+            verify = verify
+        )
+
+        return (tx, offset)
+
     def __repr__(self) -> str:
         return f"tx:\n sender: {self.sender.address}\n recipient: {self.recipient}\n amount: {self.amount}\n signed: {self.signature is not None}"
 
     def __eq__(self, other):
-        return self.hash() == other.hash()
+        return self._hash == other._hash
+
+    def __hash__(self) -> int:
+        return hash(self._hash)
 
     def __ne__(self, other):
         return not self == other
 
     @classmethod
-    def parse(cls, serialization: str):
+    def parse(cls, serialization: str, verify: bool = False):
         try:
             data = json.loads(serialization)
         except json.JSONDecodeError:
@@ -244,9 +445,10 @@ class Transaction:
             out =  cls(
                 sender = PublicKey.parse(data["sender"]),
                 recipient = data["recipient"],
-                amount = int(data["amount"] * 1000000000),
+                amount = round(data["amount"] * 1000000000),
                 prev_hash = bytes.fromhex(data["prev_hash"]),
-                signature = Signature.parse(data["signature"])
+                signature = Signature.parse(data["signature"]),
+                verify = verify
             )
 
             if out.hash().hex() != data["hash"]:
@@ -255,7 +457,13 @@ class Transaction:
         except KeyError:
             raise ValueError("This is not valid Transaction JSON serialization")
 
+        return out
+
 class CoinbaseTransaction(Transaction):
+    __slots__ = ("height",)
+
+    _immutable_fields = Transaction._immutable_fields + ("height",)
+
     def __init__(self, height: int, recipient: str, prev_hash: bytes):
         super().__init__(
             sender = None,
@@ -272,8 +480,8 @@ class CoinbaseTransaction(Transaction):
     def verify(self) -> bool:
         return self.amount == get_block_reward(self.height)
 
-    def hash(self) -> bytes:
-        return hash256(self.prev_hash + self.recipient.encode("ascii") + self.amount.to_bytes((self.amount.bit_length() + 7) // 8, "big"))
+    def _build_message(self) -> bytes:
+        return self.prev_hash + self.recipient.encode("ascii") + self.amount.to_bytes((self.amount.bit_length() + 7) // 8, "big")
 
     def serialize(self) -> str:
         return json.dumps({
@@ -284,11 +492,32 @@ class CoinbaseTransaction(Transaction):
             "hash": self.hash().hex()
         })
 
+    # Binary layout (after the version byte):
+    #   kind (1) = 1 | height (varint) | recipient (varint length + ascii) | prev_hash (32)
+    # The amount is not stored, it always is get_block_reward(height)
+    BINARY_KIND = 1
+
+    def serialize_binary(self) -> bytes:
+        return (
+            bytes((codec.CODEC_VERSION, self.BINARY_KIND)) +
+            codec.encode_varint(self.height) +
+            codec.encode_bytes(self.recipient.encode("ascii")) +
+            self.prev_hash
+        )
+
+    @classmethod
+    def _read_binary_body(cls, view: memoryview, offset: int) -> tuple:
+        height, offset = codec.decode_varint(view, offset)
+        recipient, offset = codec.decode_bytes(view, offset)
+        prev_hash, offset = codec.read_bytes(view, offset, 32)
+
+        return (cls(height = height, recipient = str(recipient, "ascii"), prev_hash = bytes(prev_hash)), offset)
+
     def __repr__(self) -> str:
         return f"coinbase:\n recipient: {self.recipient}\n amount: {self.amount}\n height: {self.height}"
 
     @classmethod
-    def parse(cls, serialization: str):
+    def parse(cls, serialization: str, verify: bool = False):
         try:
             data = json.loads(serialization)
         except json.JSONDecodeError:
@@ -307,26 +536,429 @@ class CoinbaseTransaction(Transaction):
         except KeyError:
             raise ValueError("This is not valid CoinbaseTransaction JSON serialization")
 
+        return out
+
+################################################################
+# PARALLEL SIGNATURE VERIFICATION
+################################################################
+
+def _verify_chunk(items: list) -> list:
+    # items: [(compressed pubkey, tx hash, r, s), ...]; runs in worker processes
+    points = []
+
+    for sec, _, _, _ in items:
+        try:
+            points.append(PublicKey.parse_sec(sec).content)
+        except ValueError:
+            points.append(None)
+
+    decodable = [i for i, point in enumerate(points) if point is not None]
+    failed = set(i for i, point in enumerate(points) if point is None)
+
+    failed_decodable = ecc.batch_verify([
+        (points[i], int.from_bytes(items[i][1], "big"), ecc.Signature(items[i][2], items[i][3]))
+        for i in decodable
+    ])
+    failed.update(decodable[i] for i in failed_decodable)
+
+    return [i not in failed for i in range(len(items))]
+
+class VerificationExecutor:
+    # Verifies signatures in a process pool, in chunks of compact picklable
+    # tuples. Batches smaller than inline_threshold (or with a single worker)
+    # are verified in the calling process.
+    def __init__(self, workers: int = 1, chunk_size: int = 128, inline_threshold: int = 512):
+        # 0 means one worker per CPU core
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self.inline_threshold = inline_threshold
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+
+            return self._pool
+
+    def verify(self, items: list, stop_on_failure: bool = False) -> list:
+        # Returns one entry per item: True (valid), False (invalid) or None (not
+        # checked because stop_on_failure cancelled the remaining chunks)
+        if self.workers <= 1 or len(items) < self.inline_threshold:
+            return _verify_chunk(items)
+
+        results = [None] * len(items)
+        futures = {
+            self._get_pool().submit(_verify_chunk, items[start:start + self.chunk_size]): start
+            for start in range(0, len(items), self.chunk_size)
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            start = futures[future]
+            chunk_results = future.result()
+            results[start:start + len(chunk_results)] = chunk_results
+
+            if stop_on_failure and not all(chunk_results):
+                for f in futures:
+                    f.cancel()
+
+                break
+
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+
+INLINE_VERIFIER = VerificationExecutor(workers=1)
+
+def verify_transactions(transactions: list, verifier: VerificationExecutor = None, stop_on_failure: bool = False) -> list:
+    # Returns indices of the invalid transactions (empty if all are valid). With
+    # stop_on_failure only some of the invalid ones may be reported.
+    if verifier is None:
+        verifier = INLINE_VERIFIER
+
+    failures = []
+    signed = []
+
+    for i, tx in enumerate(transactions):
+        if isinstance(tx, CoinbaseTransaction):
+            if not tx.verify():
+                failures.append(i)
+        elif tx.signature is None:
+            failures.append(i)
+        elif not SIGNATURE_CACHE.contains(SignatureCache.key(tx.hash(), tx.signature)):
+            signed.append(i)
+
+    if stop_on_failure and len(failures) > 0:
+        return failures
+
+    # The tx hash is already hash256 of the signing message, so it is used as z directly
+    results = verifier.verify(
+        [
+            (
+                transactions[i].sender.serialize_binary(),
+                transactions[i].hash(),
+                transactions[i].signature.content.r,
+                transactions[i].signature.content.s
+            )
+            for i in signed
+        ],
+        stop_on_failure = stop_on_failure
+    )
+
+    for i, valid in zip(signed, results):
+        if valid is False:
+            failures.append(i)
+        elif valid:
+            tx = transactions[i]
+            SIGNATURE_CACHE.add(SignatureCache.key(tx.hash(), tx.signature))
+
+    failures.sort()
+    return failures
+
+################################################################
+# MERKLE TREE
+################################################################
+
+MERKLE_EMPTY_ROOT = bytes(32)
+
+def merkle_leaf(tx_hash: bytes) -> bytes:
+    # Leaves and inner nodes are hashed with different prefixes so an inner
+    # node can never be passed off as a transaction
+    return hash256(b"\x00" + tx_hash)
+
+def merkle_node(left: bytes, right: bytes) -> bytes:
+    return hash256(b"\x01" + left + right)
+
+class MerkleTree:
+    # Append-only Merkle tree over transaction hashes. A node without a right
+    # sibling is carried up to the next level unchanged.
+    def __init__(self, tx_hashes: list = None):
+        self.levels = [[merkle_leaf(h) for h in (tx_hashes or [])]]
+
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            self.levels.append([self._parent(level, i) for i in range(0, len(level), 2)])
+
+    @staticmethod
+    def _parent(level: list, i: int) -> bytes:
+        if i + 1 < len(level):
+            return merkle_node(level[i], level[i + 1])
+
+        return level[i]
+
+    def __len__(self) -> int:
+        return len(self.levels[0])
+
+    def root(self) -> bytes:
+        if len(self) == 0:
+            return MERKLE_EMPTY_ROOT
+
+        return self.levels[-1][0]
+
+    def append(self, tx_hash: bytes):
+        # Only the path from the new leaf to the root is recomputed: O(log n)
+        self.levels[0].append(merkle_leaf(tx_hash))
+        index = len(self.levels[0]) - 1
+        depth = 0
+
+        while len(self.levels[depth]) > 1:
+            if depth + 1 == len(self.levels):
+                self.levels.append([])
+
+            index -= index % 2
+            node = self._parent(self.levels[depth], index)
+            index //= 2
+            upper = self.levels[depth + 1]
+
+            if index < len(upper):
+                upper[index] = node
+            else:
+                upper.append(node)
+
+            depth += 1
+
+    def proof(self, index: int) -> list:
+        # List of (sibling hash, sibling is on the left) pairs from the leaf up
+        if not 0 <= index < len(self):
+            raise IndexError("Merkle leaf index out of range")
+
+        path = []
+
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+
+            if sibling < len(level):
+                path.append((level[sibling], sibling < index))
+
+            index //= 2
+
+        return path
+
+    @staticmethod
+    def verify_proof(tx_hash: bytes, proof: list, root: bytes) -> bool:
+        node = merkle_leaf(tx_hash)
+
+        for sibling, sibling_is_left in proof:
+            if sibling_is_left:
+                node = merkle_node(sibling, node)
+            else:
+                node = merkle_node(node, sibling)
+
+        return node == root
+
+################################################################
+# MINING
+################################################################
+
+# The 16 byte nonce field is split into an extra nonce (high 64 bits) and
+# the nonce searched by the mining loop (low 64 bits)
+NONCE_BITS = 64
+
+# Number of attempts between checks of the stop/abort event
+MINING_CHECK_INTERVAL = 1 << 16
+
+def _search_nonce(header_prefix: bytes, target: bytes, extra_nonce: int, extra_nonce_step: int, stop_event) -> int:
+    # Transactions and prev_hash are hashed once, every attempt only feeds the nonce
+    midstate = hashlib.sha256(header_prefix)
+    copy = midstate.copy
+    sha256 = hashlib.sha256
+
+    while True:
+        nonce_base = extra_nonce << NONCE_BITS
+
+        for chunk in range(nonce_base, nonce_base + (1 << NONCE_BITS), MINING_CHECK_INTERVAL):
+            if stop_event.is_set():
+                return None
+
+            for nonce in range(chunk, chunk + MINING_CHECK_INTERVAL):
+                h = copy()
+                h.update(nonce.to_bytes(16, "big"))
+
+                if sha256(h.digest()).digest() <= target:
+                    return nonce
+
+        extra_nonce += extra_nonce_step
+
+def _mining_worker(header_prefix: bytes, target: bytes, extra_nonce: int, extra_nonce_step: int, stop_event, results):
+    nonce = _search_nonce(header_prefix, target, extra_nonce, extra_nonce_step, stop_event)
+
+    if nonce is not None:
+        results.put(nonce)
+
+def _search_nonce_parallel(header_prefix: bytes, target: bytes, extra_nonce: int, workers: int, abort_event) -> int:
+    # Every worker searches its own extra nonces (extra_nonce + i, + i + workers, ...)
+    ctx = multiprocessing.get_context()
+    stop_event = ctx.Event()
+    results = ctx.Queue()
+
+    processes = [
+        ctx.Process(
+            target=_mining_worker,
+            args=(header_prefix, target, extra_nonce + i, workers, stop_event, results),
+            daemon=True
+        )
+        for i in range(workers)
+    ]
+
+    for p in processes:
+        p.start()
+
+    nonce = None
+
+    try:
+        while not abort_event.is_set():
+            try:
+                nonce = results.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+    finally:
+        stop_event.set()
+
+        for p in processes:
+            p.join()
+
+    return nonce
+
+class BlockHeader:
+    __slots__ = ("height", "prev_hash", "tx_count", "merkle_root", "nonce", "_hash")
+
+    def __init__(self, height: int, prev_hash: bytes, tx_count: int, merkle_root: bytes, nonce: int):
+        self.height = height
+        self.prev_hash = prev_hash
+        self.tx_count = tx_count
+        self.merkle_root = merkle_root
+        self.nonce = nonce
+
+        self._hash = hash256(tx_count.to_bytes(4, "big") + merkle_root + prev_hash + nonce.to_bytes(16, "big"))
+
+    def hash(self) -> bytes:
+        return self._hash
+
+    def check_pow(self) -> bool:
+        return meets_target(self._hash, get_difficulty(self.height))
+
+    def serialize_binary(self) -> bytes:
+        # height | prev hash | tx count | merkle root | nonce
+        return b"".join([
+            codec.encode_varint(self.height),
+            self.prev_hash,
+            codec.encode_varint(self.tx_count),
+            self.merkle_root,
+            self.nonce.to_bytes(16, "big")
+        ])
+
+    @classmethod
+    def _read_binary(cls, view: memoryview, offset: int) -> tuple:
+        height, offset = codec.decode_varint(view, offset)
+        prev_hash, offset = codec.read_bytes(view, offset, 32)
+        tx_count, offset = codec.decode_varint(view, offset)
+        merkle_root, offset = codec.read_bytes(view, offset, 32)
+        nonce, offset = codec.read_bytes(view, offset, 16)
+
+        if tx_count >= 2**32:
+            raise ValueError("Too many transactions in block header")
+
+        header = cls(
+            height = height,
+            prev_hash = bytes(prev_hash),
+            tx_count = tx_count,
+            merkle_root = bytes(merkle_root),
+            nonce = int.from_bytes(nonce, "big")
+        )
+
+        return (header, offset)
+
+    def __repr__(self) -> str:
+        return f"header:\n height: {self.height}\n hash: {self._hash.hex()}\n nonce: {self.nonce}\n transactions: {self.tx_count}"
+
+def serialize_headers(headers: list) -> bytes:
+    out = [bytes([codec.CODEC_VERSION]), codec.encode_varint(len(headers))]
+    out.extend(header.serialize_binary() for header in headers)
+
+    return b"".join(out)
+
+def parse_headers(data, max_count: int = None) -> list:
+    view = memoryview(data)
+    offset = codec.read_version(view, 0)
+    count, offset = codec.decode_varint(view, offset)
+
+    if max_count is not None and count > max_count:
+        raise ValueError(f"Too many headers ({count})")
+
+    headers = []
+
+    for _ in range(count):
+        header, offset = BlockHeader._read_binary(view, offset)
+        headers.append(header)
+
+    if offset != len(view):
+        raise ValueError("Trailing data after binary headers")
+
+    return headers
+
 class Block:
     def __init__(self, height: int, transactions: list[Transaction], prev_hash: str = None, nonce: int = None):
         self.height = height
-        self.transactions = transactions
+        self.transactions = list(transactions)
         self.prev_hash = prev_hash
         self.nonce = nonce
 
+        self._merkle_tree = MerkleTree([tx.hash() for tx in self.transactions])
+
         if self.prev_hash is None:
             self.prev_hash = bytes(32)
 
         if self.nonce is None:
             self.nonce = 0
 
-    def hash(self) -> bytes:
+    def merkle_tree(self) -> MerkleTree:
+        if len(self._merkle_tree) != len(self.transactions):
+            # Transactions list was modified directly; rebuild the commitment
+            self._merkle_tree = MerkleTree([tx.hash() for tx in self.transactions])
+
+        return self._merkle_tree
+
+    def merkle_root(self) -> bytes:
+        return self.merkle_tree().root()
+
+    def add_transaction(self, tx: Transaction):
+        tree = self.merkle_tree()
+        self.transactions.append(tx)
+        tree.append(tx.hash())
+
+    def inclusion_proof(self, tx_hash: bytes) -> list:
+        for i, tx in enumerate(self.transactions):
+            if tx.hash() == tx_hash:
+                return self.merkle_tree().proof(i)
+
+        raise ValueError("Transaction is not in this block")
+
+    def header_prefix(self) -> bytes:
+        # Everything hashed before the nonce
         m =  len(self.transactions).to_bytes(4, "big") # max 2^32 transactions per block
-        m += b"".join([tx.hash() for tx in self.transactions])
+        m += self.merkle_root()
         m += self.prev_hash
-        m += self.nonce.to_bytes(16, "big")
 
-        return hash256(m)
+        return m
+
+    def hash(self) -> bytes:
+        return hash256(self.header_prefix() + self.nonce.to_bytes(16, "big"))
+
+    def header(self) -> BlockHeader:
+        return BlockHeader(
+            height = self.height,
+            prev_hash = self.prev_hash,
+            tx_count = len(self.transactions),
+            merkle_root = self.merkle_root(),
+            nonce = self.nonce
+        )
 
     def serialize(self) -> str:
         return json.dumps({
@@ -337,11 +969,12 @@ class Block:
             "hash": self.hash().hex()
         })
 
-    def mine(self, reward_address: str, prev_tx_hash: bytes):
+    def mine(self, reward_address: str, prev_tx_hash: bytes, extra_nonce: int = 0, workers: int = 1, abort_event = None) -> bool:
+        # Returns False if abort_event was set before a solution was found
         if len(self.transactions) > 0:
             prev_tx_hash = self.transactions[-1].hash()
 
-        self.transactions.append(
+        self.add_transaction(
             CoinbaseTransaction(
                 height = self.height,
                 recipient = reward_address,
@@ -349,98 +982,1201 @@ class Block:
             )
         )
 
-        difficulty = get_difficulty(self.height)
-        self.nonce = 0
+        target = get_target(get_difficulty(self.height))
+        header_prefix = self.header_prefix()
 
-        while self.hash().hex()[0:difficulty] != "0" * difficulty:
-            self.nonce += 1
+        if abort_event is None:
+            abort_event = threading.Event()
 
-    def validate(self) -> bool:
-        difficulty = get_difficulty(self.height)
+        if workers == 1:
+            nonce = _search_nonce(header_prefix, target, extra_nonce, 1, abort_event)
+        else:
+            nonce = _search_nonce_parallel(header_prefix, target, extra_nonce, workers, abort_event)
 
-        if self.hash().hex()[0:difficulty] != "0" * difficulty:
+        if nonce is None:
             return False
 
-        for tx in self.transactions:
-            if not tx.verify():
-                return False
+        self.nonce = nonce
+        return True
+
+    def validate(self) -> bool:
+        # Context-free checks only; linkage and balances need a Blockchain
+        try:
+            BLOCK_PIPELINE.run(self, None)
+        except ValidationError:
+            return False
 
         return True
 
+    # Binary layout:
+    #   version (1) | height (varint) | prev_hash (32) | nonce (16) | merkle root (32) |
+    #   tx count (varint) | every transaction as varint length + binary transaction
+    # Everything up to the tx count forms the header, so it can be checked
+    # before any transaction is decoded (see parse_binary_header).
+    # Version 1 blocks have no merkle root.
+    def serialize_binary(self) -> bytes:
+        out = [
+            bytes((codec.CODEC_VERSION,)),
+            codec.encode_varint(self.height),
+            self.prev_hash,
+            self.nonce.to_bytes(16, "big"),
+            self.merkle_root(),
+            codec.encode_varint(len(self.transactions))
+        ]
+
+        for tx in self.transactions:
+            out.append(codec.encode_bytes(tx.serialize_binary()))
+
+        return b"".join(out)
+
+    @staticmethod
+    def _read_binary_header(view: memoryview) -> tuple:
+        # Returns (version, height, prev_hash, nonce, merkle root or None, tx count, offset of the first transaction)
+        offset = codec.read_version(view, 0)
+        version = view[0]
+
+        height, offset = codec.decode_varint(view, offset)
+        prev_hash, offset = codec.read_bytes(view, offset, 32)
+        nonce, offset = codec.read_bytes(view, offset, 16)
+
+        merkle_root = None
+        if version >= 2:
+            merkle_root, offset = codec.read_bytes(view, offset, 32)
+
+        tx_count, offset = codec.decode_varint(view, offset)
+
+        return (version, height, prev_hash, nonce, merkle_root, tx_count, offset)
+
+    @classmethod
+    def parse_binary_header(cls, data) -> BlockHeader:
+        # Header of a binary block without decoding its transactions
+        version, height, prev_hash, nonce, merkle_root, tx_count, _ = cls._read_binary_header(memoryview(data))
+
+        if merkle_root is None:
+            raise ValueError("Version 1 blocks carry no merkle root")
+
+        if tx_count >= 2**32:
+            raise ValueError("Too many transactions in block header")
+
+        return BlockHeader(
+            height = height,
+            prev_hash = bytes(prev_hash),
+            tx_count = tx_count,
+            merkle_root = bytes(merkle_root),
+            nonce = int.from_bytes(nonce, "big")
+        )
+
+    @classmethod
+    def parse_binary(cls, data, verify: bool = False):
+        # data may be a memoryview (e.g. into the block store); nothing is copied
+        # except the fields that end up in the Block
+        view = memoryview(data)
+        version, height, prev_hash, nonce, merkle_root, tx_count, offset = cls._read_binary_header(view)
+
+        if tx_count > len(view):
+            raise ValueError("Truncated binary block")
+
+        transactions = []
+
+        for _ in range(tx_count):
+            tx_data, offset = codec.decode_bytes(view, offset)
+            tx, tx_end = Transaction._read_binary(tx_data, 0, verify)
+
+            if tx_end != len(tx_data):
+                raise ValueError("Trailing data after binary transaction")
+
+            transactions.append(tx)
+
+        if offset != len(view):
+            raise ValueError("Trailing data after binary block")
+
+        block = cls(
+            height = height,
+            transactions = transactions,
+            prev_hash = bytes(prev_hash),
+            nonce = int.from_bytes(nonce, "big")
+        )
+
+        if merkle_root is not None and block.merkle_root() != merkle_root:
+            raise ValueError("Merkle root does not match the transactions")
+
+        return block
+
     def __repr__(self) -> str:
         return f"block:\n height: {self.height}\n hash: {self.hash().hex()}\n nonce: {self.nonce}\n transactions: {len(self.transactions)}"
     
     @classmethod
-    def parse(cls, serialization: str):
+    def parse(cls, serialization: str, verify: bool = False):
         try:
             data = json.loads(serialization)
         except json.JSONDecodeError:
             raise ValueError("Cannot parse JSON serialization")
 
         try:
+            transactions = []
+
+            for tx in data["transactions"]:
+                if "height" in json.loads(tx):
+                    transactions.append(CoinbaseTransaction.parse(tx))
+                else:
+                    transactions.append(Transaction.parse(tx, verify=verify))
+
             return cls(
-                transactions = [Transaction.parse(tx) for tx in data["transactions"]],
+                height = data["height"],
+                transactions = transactions,
                 prev_hash = bytes.fromhex(data["prev_hash"]),
                 nonce = data["nonce"]
             )
         except KeyError:
             raise ValueError("This is not valid Block serialization")
 
+################################################################
+# MEMPOOL
+################################################################
+
+class Mempool:
+    # Pending transactions keyed by tx hash, in arrival order, with a per-sender
+    # index and a prev_hash -> dependants index. Bounded by count and size;
+    # when full the oldest transactions are evicted together with their dependants,
+    # unless that would evict an ancestor of the new one, which is rejected instead.
+    def __init__(self, max_transactions: int = 50000, max_size: int = 64 * 1024 * 1024):
+        self.max_transactions = max_transactions
+        self.max_size = max_size
+        self.size = 0
+
+        self._txs = OrderedDict()
+        self._by_sender = {}
+        self._dependants = {}
+        self._spends = {}  # sender address -> sum of pending amounts
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def tx_size(tx: Transaction) -> int:
+        return len(tx.message()) + 64 # signature
+
+    @staticmethod
+    def _sender_address(tx: Transaction) -> str:
+        return None if tx.sender is None else tx.sender.address
+
+    def __len__(self) -> int:
+        return len(self._txs)
+
+    def __contains__(self, tx_hash: bytes) -> bool:
+        return tx_hash in self._txs
+
+    def __iter__(self):
+        return iter(self.transactions())
+
+    def get(self, tx_hash: bytes) -> Transaction:
+        return self._txs.get(tx_hash)
+
+    def transactions(self) -> list:
+        with self._lock:
+            return list(self._txs.values())
+
+    def add(self, tx: Transaction) -> bool:
+        # Returns False if the transaction is already known or did not fit
+        tx_hash = tx.hash()
+
+        with self._lock:
+            if tx_hash in self._txs:
+                return False
+
+            self._txs[tx_hash] = tx
+            self.size += self.tx_size(tx)
+            self._by_sender.setdefault(self._sender_address(tx), OrderedDict())[tx_hash] = None
+            self._spends[self._sender_address(tx)] = self._spends.get(self._sender_address(tx), 0) + tx.amount
+            self._dependants.setdefault(tx.prev_hash, set()).add(tx_hash)
+
+            ancestors = None
+
+            while len(self._txs) > self.max_transactions or self.size > self.max_size:
+                if ancestors is None:
+                    ancestors = self._ancestors(tx)
+
+                oldest = next(iter(self._txs))
+
+                if oldest == tx_hash or oldest in ancestors:
+                    # Evicting it would take tx along; drop tx instead
+                    self._remove_one(tx_hash)
+                    return False
+
+                self.remove(oldest, with_dependants=True)
+
+            return True
+
+    def _ancestors(self, tx: Transaction) -> set:
+        # Pending transactions tx depends on
+        out = set()
+        prev = self._txs.get(tx.prev_hash)
+
+        while prev is not None and prev.hash() not in out:
+            out.add(prev.hash())
+            prev = self._txs.get(prev.prev_hash)
+
+        return out
+
+    def _remove_one(self, tx_hash: bytes) -> Transaction:
+        tx = self._txs.pop(tx_hash, None)
+
+        if tx is None:
+            return None
+
+        self.size -= self.tx_size(tx)
+
+        address = self._sender_address(tx)
+        sender_txs = self._by_sender[address]
+        del sender_txs[tx_hash]
+        if len(sender_txs) == 0:
+            del self._by_sender[address]
+            del self._spends[address]
+        else:
+            self._spends[address] -= tx.amount
+
+        siblings = self._dependants[tx.prev_hash]
+        siblings.discard(tx_hash)
+        if len(siblings) == 0:
+            del self._dependants[tx.prev_hash]
+
+        return tx
+
+    def remove(self, tx_hash: bytes, with_dependants: bool = False) -> Transaction:
+        # Returns the removed transaction (not its dependants)
+        with self._lock:
+            tx = self._remove_one(tx_hash)
+
+            if tx is None or not with_dependants:
+                return tx
+
+            # Explicit walk: dependant chains can be far deeper than the recursion limit
+            stack = list(self._dependants.get(tx_hash, ()))
+
+            while stack:
+                child = stack.pop()
+
+                if self._remove_one(child) is not None:
+                    stack.extend(self._dependants.get(child, ()))
+
+            return tx
+
+    def remove_block(self, block):
+        for tx in block.transactions:
+            self.remove(tx.hash())
+
+    def pending_spend(self, address: str) -> int:
+        return self._spends.get(address, 0)
+
+    def last_pending(self, address: str) -> bytes:
+        # Hash of the end of the sender's pending chain, None if nothing is pending
+        with self._lock:
+            hashes = self._by_sender.get(address)
+
+            if not hashes:
+                return None
+
+            # Usually the newest one; not after a disconnected block returned its transactions
+            for h in reversed(hashes):
+                if not any(c in hashes for c in self._dependants.get(h, ())):
+                    return h
+
+            return next(reversed(hashes))
+
+    def by_sender(self, address: str) -> list:
+        # Sender's pending transactions, each one following the one its prev_hash points at
+        with self._lock:
+            hashes = self._by_sender.get(address, {})
+            roots = deque(h for h in hashes if self._txs[h].prev_hash not in hashes)
+            out = []
+
+            while roots:
+                h = roots.popleft()
+                out.append(self._txs[h])
+                roots.extend(c for c in self._dependants.get(h, ()) if c in hashes)
+
+            return out
+
+################################################################
+# CHAIN STATE
+################################################################
+
+class ChainState:
+    # Balance, latest tx hash and latest *sent* tx hash of every address,
+    # updated block by block. A sender's transactions form a chain: the first
+    # spend of an address uses bytes(32) as prev_hash and every later one the
+    # hash of its last confirmed spend, so a confirmed transaction can never be
+    # included again and a sender's history has a single order. connect_block() keeps an undo record (previous values of
+    # every touched address) for the last `max_undo` blocks so they can be
+    # disconnected in O(block size).
+    def __init__(self, max_undo: int = 100):
+        self.max_undo = max_undo
+
+        self._balances = {}
+        self._last_tx = {}
+        self._last_sent = {}
+        self._undo = OrderedDict()  # height -> {address: (balance, last tx hash, last sent tx hash)}
+        self._lock = threading.RLock()
+
+    def balance(self, address: str) -> int:
+        return self._balances.get(address, 0)
+
+    def last_tx(self, address: str) -> bytes:
+        return self._last_tx.get(address)
+
+    def last_sent(self, address: str) -> bytes:
+        # prev_hash the address' next spend must use; bytes(32) if it never spent
+        return self._last_sent.get(address, bytes(32))
+
+    def spend_error(self, tx: Transaction, balances: dict, last_sent: dict) -> str:
+        # Checks tx against the state plus the pending changes in balances/last_sent
+        # (address -> value overrides) and applies it to them if it is valid.
+        # Returns the reason it is invalid, or None.
+        if not isinstance(tx, CoinbaseTransaction):
+            address = tx.sender.address
+            expected = last_sent.get(address, self.last_sent(address))
+
+            if tx.prev_hash != expected:
+                return "Transaction does not follow sender's last transaction"
+
+            balance = balances.get(address, self.balance(address))
+
+            if balance < tx.amount:
+                return "Transaction spends more than sender's balance"
+
+            balances[address] = balance - tx.amount
+            last_sent[address] = tx.hash()
+
+        balances[tx.recipient] = balances.get(tx.recipient, self.balance(tx.recipient)) + tx.amount
+        return None
+
+    def block_error(self, block: Block) -> str:
+        # Reason the block's transactions don't apply in order, or None
+        balances = {}
+        last_sent = {}
+
+        for tx in block.transactions:
+            error = self.spend_error(tx, balances, last_sent)
+
+            if error is not None:
+                return error
+
+        return None
+
+    def check_block(self, block: Block) -> bool:
+        return self.block_error(block) is None
+
+    def connect_block(self, block: Block):
+        with self._lock:
+            error = self.block_error(block)
+
+            if error is not None:
+                raise ValueError(error)
+
+            undo = {}
+
+            for tx in block.transactions:
+                tx_hash = tx.hash()
+                touched = [tx.recipient] if isinstance(tx, CoinbaseTransaction) else [tx.sender.address, tx.recipient]
+
+                for address in touched:
+                    if address not in undo:
+                        undo[address] = (self._balances.get(address), self._last_tx.get(address), self._last_sent.get(address))
+
+                    self._last_tx[address] = tx_hash
+
+                if not isinstance(tx, CoinbaseTransaction):
+                    self._balances[tx.sender.address] = self._balances.get(tx.sender.address, 0) - tx.amount
+                    self._last_sent[tx.sender.address] = tx_hash
+
+                self._balances[tx.recipient] = self._balances.get(tx.recipient, 0) + tx.amount
+
+            self._undo[block.height] = undo
+
+            while len(self._undo) > self.max_undo:
+                self._undo.popitem(last=False)
+
+    def disconnect_block(self, block: Block):
+        with self._lock:
+            undo = self._undo.pop(block.height, None)
+
+            if undo is None:
+                raise ValueError(f"No undo data for block {block.height}")
+
+            for address, values in undo.items():
+                for table, value in zip((self._balances, self._last_tx, self._last_sent), values):
+                    if value is None:
+                        table.pop(address, None)
+                    else:
+                        table[address] = value
+
+    @staticmethod
+    def touched_addresses(block: Block) -> set:
+        addresses = set()
+
+        for tx in block.transactions:
+            if not isinstance(tx, CoinbaseTransaction):
+                addresses.add(tx.sender.address)
+
+            addresses.add(tx.recipient)
+
+        return addresses
+
+################################################################
+# CHAIN VIEW
+################################################################
+
+class ChainView:
+    # List-like view of the chain. Headers of every block stay in memory, full
+    # blocks only for the most recent `resident_blocks` heights; older blocks are
+    # loaded from the store on demand and kept in an LRU cache.
+    # Without a store nothing can be reloaded, so every block stays resident.
+    def __init__(self, store = None, resident_blocks: int = 100, cache_size: int = 1000):
+        self.store = store
+        self.resident_blocks = resident_blocks
+        self.cache_size = cache_size
+
+        self.headers = []
+        self._heights = {}            # block hash -> height
+        self._blocks = OrderedDict()  # height -> Block, recent blocks and LRU cache
+        self._lock = threading.RLock()
+
+    def load_from_store(self, callback = None):
+        # Indexes every stored block, passing each one to callback(block)
+        for height in range(len(self.headers), len(self.store)):
+            block = self._load(height)
+            self.headers.append(block.header())
+            self._heights[self.headers[-1].hash()] = height
+
+            if callback is not None:
+                callback(block)
+
+    def _load(self, height: int) -> Block:
+        # Blocks in the store were validated before they were written
+        return self.store.parse(height, lambda view: Block.parse_binary(view, verify=False))
+
+    def _resident(self, height: int) -> bool:
+        return height >= len(self.headers) - self.resident_blocks
+
+    def _trim(self):
+        if self.store is None:
+            return
+
+        cached = [h for h in self._blocks if not self._resident(h)]
+
+        for height in cached[:max(0, len(cached) - self.cache_size)]:
+            del self._blocks[height]
+
+    def __len__(self) -> int:
+        return len(self.headers)
+
+    def __getitem__(self, height: int) -> Block:
+        if isinstance(height, slice):
+            return [self[h] for h in range(*height.indices(len(self)))]
+
+        if height < 0:
+            height += len(self.headers)
+
+        if not 0 <= height < len(self.headers):
+            raise IndexError("Block height out of range")
+
+        with self._lock:
+            block = self._blocks.get(height)
+
+            if block is None:
+                block = self._load(height)
+                self._blocks[height] = block
+                self._trim()
+            else:
+                self._blocks.move_to_end(height)
+
+            return block
+
+    def __iter__(self):
+        for height in range(len(self.headers)):
+            yield self[height]
+
+    def header(self, height: int) -> BlockHeader:
+        return self.headers[height]
+
+    def height_of(self, block_hash: bytes) -> int:
+        # None if the block is not in the chain
+        return self._heights.get(block_hash)
+
+    def append(self, block: Block):
+        with self._lock:
+            self.headers.append(block.header())
+            self._heights[self.headers[-1].hash()] = block.height
+            self._blocks[block.height] = block
+            self._trim()
+
+    def pop(self) -> Block:
+        with self._lock:
+            block = self[-1]
+            self._heights.pop(self.headers.pop().hash(), None)
+            self._blocks.pop(block.height, None)
+
+            return block
+
+################################################################
+# VALIDATION PIPELINE
+################################################################
+
+MAX_BLOCK_TRANSACTIONS = 100000
+RECENT_TX_CACHE_SIZE = 100000
+MAX_RECIPIENT_LENGTH = 64
+
+class ValidationError(ValueError):
+    def __init__(self, stage: str, message: str):
+        super().__init__(message)
+        self.stage = stage
+
+class ValidationPipeline:
+    # Ordered list of (name, check) stages, cheapest first. check(item, blockchain)
+    # raises ValidationError to reject; blockchain may be None, in which case
+    # stages that need chain context are skipped. Time spent and rejections are
+    # recorded per stage.
+    def __init__(self, stages: list, needs_chain: tuple = ()):
+        self.stages = stages
+        self.needs_chain = needs_chain
+        self.timings = {name: {"runs": 0, "rejected": 0, "seconds": 0.0} for name, _ in stages}
+        self._lock = threading.Lock()
+
+    def _record(self, name: str, start: float, rejected: bool):
+        with self._lock:
+            timing = self.timings[name]
+            timing["runs"] += 1
+            timing["seconds"] += time.perf_counter() - start
+
+            if rejected:
+                timing["rejected"] += 1
+
+    def timed(self, name: str, func):
+        # Runs one stage's work outside run(), e.g. batched over many items
+        start = time.perf_counter()
+        rejected = True
+
+        try:
+            out = func()
+            rejected = False
+            return out
+        finally:
+            self._record(name, start, rejected)
+
+    def run(self, item, blockchain, skip: tuple = ()):
+        for name, check in self.stages:
+            if name in skip or (blockchain is None and name in self.needs_chain):
+                continue
+
+            start = time.perf_counter()
+            rejected = True
+
+            try:
+                check(item, blockchain)
+                rejected = False
+            finally:
+                self._record(name, start, rejected)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {name: dict(timing) for name, timing in self.timings.items()}
+
+def _check_tx_structure(tx: Transaction, stage: str):
+    if not isinstance(tx, Transaction):
+        raise ValidationError(stage, "Not a transaction")
+
+    if not isinstance(tx.amount, int) or tx.amount <= 0:
+        raise ValidationError(stage, "Invalid transaction amount")
+
+    if not isinstance(tx.recipient, str) or len(tx.recipient) > MAX_RECIPIENT_LENGTH:
+        raise ValidationError(stage, "Invalid transaction recipient")
+
+    if not isinstance(tx.prev_hash, bytes) or len(tx.prev_hash) != 32:
+        raise ValidationError(stage, "Invalid transaction prev_hash")
+
+    if not isinstance(tx, CoinbaseTransaction) and (tx.sender is None or tx.signature is None):
+        raise ValidationError(stage, "Transaction is not signed")
+
+def _block_structure(block: Block, blockchain):
+    if not isinstance(block.height, int) or block.height < 0:
+        raise ValidationError("structure", "Invalid block height")
+
+    if not isinstance(block.prev_hash, bytes) or len(block.prev_hash) != 32:
+        raise ValidationError("structure", "Invalid block prev_hash")
+
+    if not 0 < len(block.transactions) <= MAX_BLOCK_TRANSACTIONS:
+        raise ValidationError("structure", "Invalid number of transactions in block")
+
+    for tx in block.transactions:
+        _check_tx_structure(tx, "structure")
+
+    coinbase = block.transactions[-1]
+
+    if not isinstance(coinbase, CoinbaseTransaction) or any(isinstance(tx, CoinbaseTransaction) for tx in block.transactions[:-1]):
+        raise ValidationError("structure", "Block must end with its only coinbase transaction")
+
+    if coinbase.height != block.height or not coinbase.verify():
+        raise ValidationError("structure", "Invalid coinbase transaction")
+
+def _block_hashes(block: Block, blockchain):
+    hashes = set()
+
+    for tx in block.transactions:
+        if tx.hash() in hashes:
+            raise ValidationError("hashes", "Duplicate transaction in block")
+
+        hashes.add(tx.hash())
+
+    if len(block.transactions) > 1 and block.transactions[-1].prev_hash != block.transactions[-2].hash():
+        raise ValidationError("hashes", "Coinbase does not follow the last transaction")
+
+def _block_linkage(block: Block, blockchain):
+    if block.height != len(blockchain.chain):
+        raise ValidationError("linkage", "Invalid or late block")
+
+    if len(blockchain.chain) > 0:
+        if block.prev_hash != blockchain.chain.headers[-1].hash():
+            raise ValidationError("linkage", "Invalid or late block")
+    else:
+        if block.prev_hash != bytes(32):
+            raise ValidationError("linkage", "Previous hash of genesis block is not zero")
+
+def _block_pow(block: Block, blockchain):
+    if not meets_target(block.hash(), get_difficulty(block.height)):
+        raise ValidationError("pow", "Block hash does not meet the target")
+
+def _block_state(block: Block, blockchain):
+    error = blockchain.state.block_error(block)
+
+    if error is not None:
+        raise ValidationError("state", error)
+
+def _block_signatures(block: Block, blockchain):
+    verifier = None if blockchain is None else blockchain.verifier
+
+    if len(verify_transactions(block.transactions, verifier, stop_on_failure=True)) > 0:
+        raise ValidationError("signatures", "Invalid block")
+
+BLOCK_PIPELINE = ValidationPipeline(
+    stages = [
+        ("structure", _block_structure),
+        ("hashes", _block_hashes),
+        ("linkage", _block_linkage),
+        ("pow", _block_pow),
+        ("state", _block_state),
+        ("signatures", _block_signatures)
+    ],
+    needs_chain = ("linkage", "state")
+)
+
+# Runs on a BlockHeader from Block.parse_binary_header, before any transaction
+# of a received block is decoded. It doesn't read the chain, so it is safe
+# outside the chain lock; linkage is left to Blockchain.add_block.
+def _header_structure(header: BlockHeader, blockchain):
+    if not 0 < header.tx_count <= MAX_BLOCK_TRANSACTIONS:
+        raise ValidationError("structure", "Invalid number of transactions in block")
+
+HEADER_PIPELINE = ValidationPipeline(
+    stages = [
+        ("structure", _header_structure),
+        ("pow", _block_pow)
+    ]
+)
+
+def parse_block(data) -> Block:
+    # Decodes a received binary block, rejecting it on its header alone
+    # (structure, pow) before any transaction is decoded
+    try:
+        header = Block.parse_binary_header(data)
+    except ValueError as err:
+        raise ValidationError("structure", str(err))
+
+    HEADER_PIPELINE.run(header, None)
+
+    try:
+        return Block.parse_binary(data)
+    except ValueError as err:
+        raise ValidationError("structure", str(err))
+
+def _tx_structure(tx: Transaction, blockchain):
+    _check_tx_structure(tx, "structure")
+
+    if isinstance(tx, CoinbaseTransaction):
+        raise ValidationError("structure", "Coinbase transactions are only valid in blocks")
+
+def _tx_hashes(tx: Transaction, blockchain):
+    if tx.hash() in blockchain.mempool:
+        raise ValidationError("hashes", "Transaction is already pending")
+
+    if blockchain.is_confirmed(tx.hash(), tx.sender.address):
+        raise ValidationError("hashes", "Transaction is already confirmed")
+
+def _tx_state(tx: Transaction, blockchain):
+    address = tx.sender.address
+    expected = blockchain.mempool.last_pending(address) or blockchain.state.last_sent(address)
+
+    if tx.prev_hash != expected:
+        raise ValidationError("state", "Transaction does not follow sender's last transaction")
+
+    if blockchain.state.balance(address) - blockchain.mempool.pending_spend(address) < tx.amount:
+        raise ValidationError("state", "Transaction spends more than sender's balance")
+
+def _tx_signatures(tx: Transaction, blockchain):
+    if len(verify_transactions([tx], blockchain.verifier)) > 0:
+        raise ValidationError("signatures", "Invalid transaction")
+
+TRANSACTION_PIPELINE = ValidationPipeline(
+    stages = [
+        ("structure", _tx_structure),
+        ("hashes", _tx_hashes),
+        ("state", _tx_state),
+        ("signatures", _tx_signatures)
+    ],
+    needs_chain = ("hashes", "state")
+)
+
 class Blockchain:
-    def __init__(self):
-        self.chain = []
-        self.pending_transactions = []
+    def __init__(
+        self,
+        mining_workers: int = 1,
+        mempool_max_transactions: int = 50000,
+        mempool_max_size: int = 64 * 1024 * 1024,
+        store = None,
+        resident_blocks: int = 100,
+        block_cache_size: int = 1000,
+        tx_index = None,
+        address_index = None,
+        verification_workers: int = 1
+    ):
+        # Optional storage.BlockStore; every added block is written through to it
+        self.store = store
+
+        # Optional storage.TxIndex and storage.AddressIndex
+        self.tx_index = tx_index
+        self.address_index = address_index
+
+        self.chain = ChainView(store=store, resident_blocks=resident_blocks, cache_size=block_cache_size)
+        self.mempool = Mempool(max_transactions=mempool_max_transactions, max_size=mempool_max_size)
+        self.state = ChainState()
+        self.verifier = VerificationExecutor(workers=verification_workers)
+
+        # 0 means one worker per CPU core
+        self.mining_workers = mining_workers if mining_workers > 0 else (os.cpu_count() or 1)
+
+        # Set when a new tip or new transactions make the current mining job stale
+        self.mining_abort = threading.Event()
+
+        # Optional callable(type, hash, height) telling peers about transactions
+        # created and blocks mined by this node (see protocol.setup)
+        self.announce = None
+
+        # Taken by everything that changes the chain, state, mempool, store or indexes
+        self._lock = threading.RLock()
+
+        # Hashes of transactions in recently connected blocks, so re-sent
+        # confirmed transactions are recognised without the tx index
+        self.recent_txs = OrderedDict()
+
+        if self.store is not None:
+            for index in (self.tx_index, self.address_index):
+                # Drop anything indexed past the stored chain (e.g. after a torn write)
+                if index is not None:
+                    for height in range(index.height() - 1, len(self.store) - 1, -1):
+                        index.remove_block(height)
+
+            self.chain.load_from_store(self._load_block)
+
+    def _load_block(self, block: Block):
+        self.state.connect_block(block)
+
+        # Lets indexes enabled after the chain was stored catch up
+        if self.tx_index is not None and block.height >= self.tx_index.height():
+            self._index_tx(block)
+
+        if self.address_index is not None and block.height >= self.address_index.height():
+            self._index_addresses(block)
+
+    def _index_tx(self, block: Block):
+        self.tx_index.add_block(block.height, [tx.hash() for tx in block.transactions])
+
+    def _index_addresses(self, block: Block):
+        entries = []
+
+        for position, tx in enumerate(block.transactions):
+            if not isinstance(tx, CoinbaseTransaction):
+                entries.append((tx.sender.address, position))
+
+            if tx.sender is None or tx.recipient != tx.sender.address:
+                entries.append((tx.recipient, position))
+
+        self.address_index.add_block(block.height, entries)
 
     def add_block(self, block: Block):
-        if not block.validate():
-            raise ValueError("Invalid block")
+        # Raises ValidationError (a ValueError) naming the stage that rejected the block.
+        # The block is persisted before the in-memory state changes, and any
+        # failure after that is rolled back, so a block is either fully
+        # connected or not at all.
+        with self._lock:
+            BLOCK_PIPELINE.run(block, self)
+
+            if self.store is not None:
+                self.store.append(block.height, block.hash(), block.serialize_binary())
+
+            try:
+                self.state.connect_block(block)
+
+                try:
+                    if self.tx_index is not None:
+                        self._index_tx(block)
+
+                    if self.address_index is not None:
+                        self._index_addresses(block)
+                except BaseException:
+                    for index in (self.tx_index, self.address_index):
+                        if index is not None:
+                            index.remove_block(block.height)
+
+                    self.state.disconnect_block(block)
+                    raise
+            except BaseException:
+                if self.store is not None:
+                    self.store.truncate(block.height)
+
+                raise
+
+            self.chain.append(block)
+            self.mempool.remove_block(block)
+            self._remember_txs(block)
+            self._revalidate_mempool(ChainState.touched_addresses(block))
+            self.mining_abort.set()
+
+    def disconnect_tip(self) -> Block:
+        # Removes the last block and returns its transactions to the mempool
+        with self._lock:
+            block = self.chain[-1]
+            self.state.disconnect_block(block)
+
+            for index in (self.tx_index, self.address_index):
+                if index is not None:
+                    index.remove_block(block.height)
+
+            if self.store is not None:
+                self.store.truncate(block.height)
+
+            self.chain.pop()
+
+            for tx in block.transactions:
+                self.recent_txs.pop(tx.hash(), None)
+
+                if not isinstance(tx, CoinbaseTransaction):
+                    self.mempool.add(tx)
+
+            self._revalidate_mempool(ChainState.touched_addresses(block))
+            self.mining_abort.set()
+            return block
+
+    def _remember_txs(self, block: Block):
+        for tx in block.transactions:
+            self.recent_txs[tx.hash()] = None
+
+        while len(self.recent_txs) > RECENT_TX_CACHE_SIZE:
+            self.recent_txs.popitem(last=False)
+
+    def is_confirmed(self, tx_hash: bytes, sender_address: str = None) -> bool:
+        # Exact with the tx index; otherwise covers recent blocks and every sender's last spend
+        if tx_hash in self.recent_txs:
+            return True
+
+        if sender_address is not None and self.state.last_sent(sender_address) == tx_hash:
+            return True
+
+        return self.tx_index is not None and self.tx_index.get(tx_hash) is not None
+
+    def _revalidate_mempool(self, addresses):
+        # Evicts pending transactions of these senders that no longer chain from
+        # or fit into the confirmed state (after a block was connected or disconnected)
+        for address in addresses:
+            expected = self.state.last_sent(address)
+            available = self.state.balance(address)
+
+            for tx in self.mempool.by_sender(address):
+                if tx.hash() not in self.mempool:
+                    # Already evicted as a dependant
+                    continue
+
+                if tx.prev_hash != expected or tx.amount > available:
+                    self.mempool.remove(tx.hash(), with_dependants=True)
+                    continue
+
+                expected = tx.hash()
+                available -= tx.amount
+
+    def _block_template(self) -> list:
+        # Pending transactions that apply to the current state, in an order that
+        # does (arrival order, postponing those that depend on later arrivals)
+        balances = {}
+        last_sent = {}
+        selected = []
+        pending = self.mempool.transactions()
+
+        while pending and len(selected) < MAX_BLOCK_TRANSACTIONS - 1:
+            deferred = []
+
+            for tx in pending:
+                if len(selected) >= MAX_BLOCK_TRANSACTIONS - 1:
+                    break
+
+                # spend_error only updates the overrides when tx applies
+                if self.state.spend_error(tx, balances, last_sent) is None:
+                    selected.append(tx)
+                else:
+                    deferred.append(tx)
+
+            if len(deferred) == len(pending):
+                break
+
+            pending = deferred
+
+        return selected
+
+    def connect_blocks(self, fork_height: int, blocks: list) -> int:
+        # Switches to a branch that leaves the chain at fork_height: our blocks
+        # from fork_height up are disconnected and `blocks` connected instead.
+        # If a block is invalid and the new branch ended up no longer than the
+        # old one, the old branch is restored. Returns the number of connected
+        # blocks; the ValidationError of an invalid block is re-raised.
+        with self._lock:
+            if len(self.chain) - fork_height > self.state.max_undo:
+                raise ValueError("Reorganization is deeper than the kept undo data")
+
+            disconnected = []
+            while len(self.chain) > fork_height:
+                disconnected.append(self.disconnect_tip())
+
+            connected = 0
+
+            try:
+                for block in blocks:
+                    self.add_block(block)
+                    connected += 1
+            except ValueError:
+                if connected <= len(disconnected):
+                    while len(self.chain) > fork_height:
+                        self.disconnect_tip()
+
+                    for block in reversed(disconnected):
+                        self.add_block(block)
+
+                raise
+
+            return connected
+
+    def locator(self) -> list:
+        # Hashes of our blocks, dense near the tip and exponentially sparser
+        # towards genesis, so a peer can find the fork point in one round trip
+        hashes = []
+        height = len(self.chain) - 1
+        step = 1
+
+        while height > 0:
+            try:
+                hashes.append(self.chain.header(height).hash())
+            except IndexError:
+                # Disconnected by another thread meanwhile; carry on from the new tip
+                height = len(self.chain) - 1
+                continue
+
+            if len(hashes) >= 10:
+                step *= 2
+
+            height -= step
 
         if len(self.chain) > 0:
-            if block.prev_hash != self.chain[-1].hash():
-                raise ValueError("Invalid or late block")
-        else:
-            if block.prev_hash != bytes(32):
-                raise ValueError("Previous hash of genesis block is not zero")
+            hashes.append(self.chain.header(0).hash())
+
+        return hashes
+
+    def headers_after(self, locator: list, max_count: int) -> list:
+        # Headers following the first locator hash found in our chain (from genesis if none is)
+        start = 0
+
+        for block_hash in locator:
+            height = self.chain.height_of(block_hash)
+
+            if height is not None:
+                start = height + 1
+                break
+
+        return self.chain.headers[start:start + max_count]
+
+    def balance(self, address: str) -> int:
+        return self.state.balance(address)
 
-        self.chain.append(block)
+    def validation_stats(self) -> dict:
+        return {
+            "header": HEADER_PIPELINE.stats(),
+            "block": BLOCK_PIPELINE.stats(),
+            "transaction": TRANSACTION_PIPELINE.stats()
+        }
+
+    def find_transaction(self, tx_hash: bytes) -> Transaction:
+        if self.tx_index is None:
+            raise ValueError("Transaction index is disabled")
+
+        location = self.tx_index.get(tx_hash)
+
+        if location is None:
+            return None
+
+        height, position = location
+        return self.chain[height].transactions[position]
+
+    def address_history(self, address: str, offset: int = 0, limit: int = 100) -> list:
+        # Transactions sent or received by address, oldest first
+        if self.address_index is None:
+            raise ValueError("Address index is disabled")
+
+        return [
+            self.chain[height].transactions[position]
+            for height, position in self.address_index.history(address, offset, limit)
+        ]
+
+    def close(self):
+        with self._lock:
+            self.verifier.close()
+
+            for db in (self.store, self.tx_index, self.address_index):
+                if db is not None:
+                    db.close()
+
+    @property
+    def pending_transactions(self) -> list:
+        return self.mempool.transactions()
 
     def add_transaction(self, tx: Transaction):
-        if not tx.verify():
+        if len(self.add_transactions([tx])) > 0:
             raise ValueError("Invalid transaction")
-        
-        self.pending_transactions.append(tx)
 
-    def create_transaction(self, tx: Transaction):
-        self.add_transaction(tx)
+    def add_transactions(self, transactions: list) -> list:
+        # Adds every valid transaction and returns indices of the rejected ones
+        # (invalid, already pending or evicted right away). The cheap stages run
+        # per transaction, with the state stage applied to the batch in order so
+        # a sender's chained transactions can arrive together; signatures are
+        # then checked in one batch.
+        with self._lock:
+            candidates = []
+            failures = set()
+
+            for i, tx in enumerate(transactions):
+                try:
+                    TRANSACTION_PIPELINE.run(tx, self, skip=("state", "signatures"))
+                    candidates.append(i)
+                except ValidationError:
+                    failures.add(i)
 
-        # TODO: broadcast new transaction to all nodes
+            def check_state() -> list:
+                balances = {}
+                last_sent = {}
+                seen = set()
+                passed = []
 
-    def mine(self, reward_address: str):
-        if len(self.chain) > 0:
-            last_block_hash = self.chain[-1].hash()
-            lest_tx_hash = self.chain[-1].transactions[-1].hash()
-        else:
-            last_block_hash = bytes(32)
-            lest_tx_hash = bytes(32)
+                for i in candidates:
+                    tx = transactions[i]
+                    address = tx.sender.address
 
-        new_block = Block(
-            height = len(self.chain),
-            transactions = self.pending_transactions,
-            prev_hash = last_block_hash
-        )
+                    if address not in seen:
+                        seen.add(address)
+                        pending = self.mempool.last_pending(address)
+                        if pending is not None:
+                            last_sent[address] = pending
+
+                        balances[address] = self.state.balance(address) - self.mempool.pending_spend(address)
+
+                    if self.state.spend_error(tx, balances, last_sent) is None:
+                        passed.append(i)
+                    else:
+                        failures.add(i)
+
+                return passed
+
+            candidates = TRANSACTION_PIPELINE.timed("state", check_state)
+
+            failed_signatures = TRANSACTION_PIPELINE.timed(
+                "signatures",
+                lambda: verify_transactions([transactions[i] for i in candidates], self.verifier)
+            )
+            failures.update(candidates[i] for i in failed_signatures)
+
+            accepted = 0
+            for i in candidates:
+                if i in failures:
+                    continue
+
+                tx = transactions[i]
+
+                # Earlier transactions of this batch are pending by now (or were rejected)
+                try:
+                    _tx_state(tx, self)
+                except ValidationError:
+                    failures.add(i)
+                    continue
+
+                if self.mempool.add(tx):
+                    accepted += 1
+                else:
+                    failures.add(i)
 
-        new_block.mine(
+            if accepted > 0:
+                self.mining_abort.set()
+
+            # Accepted ones may have been evicted by later ones of the batch when the mempool was full
+            failures.update(i for i in candidates if transactions[i].hash() not in self.mempool)
+
+            return sorted(failures)
+
+    def create_transaction(self, tx: Transaction):
+        self.add_transaction(tx)
+
+        if self.announce is not None:
+            self.announce("tx", tx.hash())
+
+    def mine(self, reward_address: str) -> Block:
+        # Returns the mined block, or None if the job was aborted by a new tip or new transactions
+        with self._lock:
+            self.mining_abort.clear()
+
+            if len(self.chain) > 0:
+                last_block_hash = self.chain.headers[-1].hash()
+                lest_tx_hash = self.chain[-1].transactions[-1].hash()
+            else:
+                last_block_hash = bytes(32)
+                lest_tx_hash = bytes(32)
+
+            new_block = Block(
+                height = len(self.chain),
+                transactions = self._block_template(),
+                prev_hash = last_block_hash
+            )
+
+        # The proof of work runs without the lock; a block connected meanwhile sets mining_abort
+        mined = new_block.mine(
             reward_address = reward_address,
-            prev_tx_hash = lest_tx_hash
+            prev_tx_hash = lest_tx_hash,
+            workers = self.mining_workers,
+            abort_event = self.mining_abort
         )
 
-        for tx in self.pending_transactions.copy():
-            if tx in new_block.transactions:
-                try:
-                    self.pending_transactions.remove(tx)
-                except ValueError:
-                    pass
+        if not mined:
+            return None
+
+        try:
+            self.add_block(new_block)
+        except ValidationError as err:
+            if err.stage != "linkage":
+                raise
+
+            # The tip changed just as the block was found
+            return None
 
-        self.add_block(new_block)
+        if self.announce is not None:
+            self.announce("block", new_block.hash(), new_block.height)
 
-        # TODO: broadcast new block to all nodes
+        return new_block
@@ -42,6 +42,8 @@ class Client:
         handler.start()
 
         self._servers.append(handler)
+        protocol.on_connected(handler)
+
         return True
 
     @handle_exception(_logger)
@@ -0,0 +1,69 @@
+################################################################
+# BINARY WIRE AND STORAGE FORMAT HELPERS
+################################################################
+
+# Every top-level binary serialization (Transaction, Block) starts with this byte
+# Version 2 added the merkle root to blocks; version 1 data is still readable
+CODEC_VERSION = 2
+MIN_CODEC_VERSION = 1
+
+def encode_varint(n: int) -> bytes:
+    # Unsigned LEB128: 7 bits per byte, least significant group first
+    if n < 0:
+        raise ValueError("Varint cannot be negative")
+
+    out = bytearray()
+
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+
+    out.append(n)
+    return bytes(out)
+
+def decode_varint(view: memoryview, offset: int) -> tuple:
+    # Returns (value, offset after the varint)
+    n = 0
+    shift = 0
+
+    while True:
+        if offset >= len(view):
+            raise ValueError("Truncated varint")
+
+        byte = view[offset]
+        offset += 1
+        n |= (byte & 0x7f) << shift
+
+        if not byte & 0x80:
+            return (n, offset)
+
+        shift += 7
+
+        if shift > 128:
+            raise ValueError("Varint too long")
+
+def read_bytes(view: memoryview, offset: int, n: int) -> tuple:
+    # Returns (view of the next n bytes, offset after them) without copying
+    end = offset + n
+
+    if end > len(view):
+        raise ValueError("Truncated binary serialization")
+
+    return (view[offset:end], end)
+
+def encode_bytes(data: bytes) -> bytes:
+    return encode_varint(len(data)) + data
+
+def decode_bytes(view: memoryview, offset: int) -> tuple:
+    # Length-prefixed field
+    n, offset = decode_varint(view, offset)
+    return read_bytes(view, offset, n)
+
+def read_version(view: memoryview, offset: int) -> int:
+    if offset >= len(view):
+        raise ValueError("Truncated binary serialization")
+
+    if not MIN_CODEC_VERSION <= view[offset] <= CODEC_VERSION:
+        raise ValueError(f"Unsupported binary serialization version {view[offset]}")
+
+    return offset + 1
@@ -1,10 +1,15 @@
 import threading
 import socket
+import select
+import queue
 
 import protocol
 import logger
 from exception_handler import handle_exception
 
+# Longest a connection thread sleeps without any socket activity
+SELECT_TIMEOUT = 1.0
+
 class ConnHandler(threading.Thread):
     logger = None
 
@@ -14,35 +19,121 @@ class ConnHandler(threading.Thread):
         self.conn = conn
         self.addr = addr
 
-        self.send_queue = []
+        self.send_queue = protocol.SendQueue()
+        self.send_lock = threading.Lock()
+        self.running = True
+        self.decoder = protocol.FrameDecoder()
+        self.callbacks = queue.SimpleQueue()  # posted from other threads, run by this one
+        # Other threads write a byte here to wake the connection thread up
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(0)
+        self._wakeup_send.setblocking(0)
+        # Inventory (tx/block hashes) this peer has announced or been sent
+        self.known_inventory = protocol.RollingBloomFilter()
         self.logger = logger.Logger(f"CONN/{self.addr[0]}:{self.addr[1]}")
 
     @handle_exception(logger)
     def run(self):
         self.conn.setblocking(0)
-        running = True
 
-        while running:
+        try:
+            self._serve()
+        finally:
+            self.conn.close()
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
+
+    def _serve(self):
+        while self.running:
+            with self.send_lock:
+                sending = len(self.send_queue) > 0
+
+            # Sleeps until the peer sends, the socket can take queued data or
+            # another thread queues a frame or callback; the timeout keeps the
+            # stall check going
+            readable, _, _ = select.select(
+                [self.conn, self._wakeup_recv],
+                [self.conn] if sending else [],
+                [],
+                SELECT_TIMEOUT
+            )
+
+            if self._wakeup_recv in readable:
+                try:
+                    while self._wakeup_recv.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+            if self.conn in readable:
+                try:
+                    self.decoder.recv_from(self.conn)
+                except BlockingIOError:
+                    # Spurious wakeup
+                    pass
+                except (protocol.DisconnectedError, ConnectionError):
+                    self.logger.warn("Connection has been closed by another peer.")
+                    return
+
             try:
-                message = protocol.recv_msg(self.conn)
-            except protocol.DisconnectedError:
-                self.logger.warn("Connection has been closed by another peer.")
-                self.conn.close()
+                for message in self.decoder.frames():
+                    try:
+                        protocol.handle_message(self, message)
+                    except protocol.InvalidMessageReceived as err:
+                        self.logger.error(
+                            "Received invalid message message from another peer:" +
+                            f"    {err}" +
+                            "    Ignoring."
+                        )
+            except protocol.InvalidMessageReceived as err:
+                # Broken framing, the stream can't be resynchronized
+                self.logger.error(f"Received invalid frame from another peer: {err} Disconnecting.")
                 return
 
-            if message is not None:
+            while True:
+                try:
+                    callback, args = self.callbacks.get_nowait()
+                except queue.Empty:
+                    break
+
+                callback(*args)
+
+            with self.send_lock:
                 try:
-                    protocol.handle_message(self, message)
-                except protocol.InvalidMessageReceived as err:
-                    self.logger.error(
-                        "Received invalid message message from another peer:" +
-                        f"    {err}" +
-                        "    Ignoring."
-                    )
+                    self.send_queue.send_to(self.conn)
+                except ConnectionError:
+                    self.logger.warn("Connection has been closed by another peer.")
+                    return
+
+                stalled = self.send_queue.stalled()
+
+            if stalled:
+                self.logger.warn("Peer is not reading its messages. Disconnecting.")
+                return
+
+    def _wake(self):
+        # Interrupts the select in _serve; a full wakeup socket already does that
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            pass
+
+    def send_frame(self, frame: bytes):
+        # Safe to call from any thread, never blocks
+        with self.send_lock:
+            queued = self.send_queue.put(frame)
+
+        if not queued:
+            self.logger.warn("Send queue is full. Disconnecting.")
+            self.running = False
+
+        self._wake()
 
-            if len(self.send_queue) > 0:
-                protocol.send_msg(self.conn, self.send_queue.pop(0))
+    def post(self, callback, *args):
+        # Runs callback(*args) on this connection's thread; safe to call from any thread
+        self.callbacks.put((callback, args))
+        self._wake()
 
     @handle_exception(logger)
-    def send(message: bytes):
-        self.send_queue.append(message)
+    def send(self, message: str):
+        self.send_frame(protocol.frame_msg(message))
@@ -1,5 +1,7 @@
 import hashlib
 import hmac
+import os
+import threading
 from io import BytesIO
 
 class FieldElement:
@@ -130,6 +132,135 @@ class Point:
             coef >>= 1
         return result
 
+################################################################
+# INTERLEAVED (STRAUSS) MULTI-SCALAR MULTIPLICATION WITH wNAF
+################################################################
+
+_G_WNAF_WINDOW = 8
+_P_WNAF_WINDOW = 5
+
+_g_odd_multiples = None
+_g_endo_odd_multiples = None
+
+def _wnaf(k: int, w: int) -> list:
+    # Width-w non-adjacent form, least significant digit first. Every non-zero
+    # digit is odd and lies in (-2^(w-1), 2^(w-1)).
+    digits = []
+    window = 1 << w
+    half = window >> 1
+
+    while k:
+        if k & 1:
+            d = k & (window - 1)
+
+            if d >= half:
+                d -= window
+
+            k -= d
+        else:
+            d = 0
+
+        digits.append(d)
+        k >>= 1
+
+    return digits
+
+def _odd_multiples(x: int, y: int, w: int) -> list:
+    # [P, 3P, 5P, ..., (2^(w-1) - 1)P] in affine coordinates
+    p = (x, y, 1)
+    p2 = _jacobian_double(p)
+    points = [p]
+
+    for _ in range((1 << (w - 2)) - 1):
+        points.append(_jacobian_add(points[-1], p2))
+
+    return _jacobian_batch_to_affine(points)
+
+def _generator_odd_multiples() -> list:
+    global _g_odd_multiples
+
+    if _g_odd_multiples is None:
+        _g_odd_multiples = _odd_multiples(S256_G.x.num, S256_G.y.num, _G_WNAF_WINDOW)
+
+    return _g_odd_multiples
+
+def _generator_endo_odd_multiples() -> list:
+    global _g_endo_odd_multiples
+
+    if _g_endo_odd_multiples is None:
+        _g_endo_odd_multiples = _endomorphism_table(_generator_odd_multiples())
+
+    return _g_endo_odd_multiples
+
+def _jacobian_multi_multiply(terms: list) -> tuple:
+    # terms: [(scalar, odd_multiples, window), ...]; computes sum(scalar * point)
+    # sharing one doubling chain between all of them.
+    nafs = [
+        (_wnaf(k, w) if k >= 0 else [-d for d in _wnaf(-k, w)], table)
+        for k, table, w in terms
+    ]
+    length = max((len(naf) for naf, _ in nafs), default=0)
+    result = _JACOBIAN_INFINITY
+
+    for i in range(length - 1, -1, -1):
+        result = _jacobian_double(result)
+
+        for naf, table in nafs:
+            if i >= len(naf):
+                continue
+
+            d = naf[i]
+
+            if d > 0:
+                x, y = table[d >> 1]
+                result = _jacobian_add_affine(result, x, y)
+            elif d < 0:
+                x, y = table[(-d) >> 1]
+                result = _jacobian_add_affine(result, x, S256_PRIME - y)
+
+    return result
+
+################################################################
+# GLV ENDOMORPHISM
+################################################################
+
+# phi(x, y) = (beta * x, y) equals lambda * (x, y) on secp256k1, so a 256-bit
+# scalar k can be split into k1 + k2 * lambda with k1, k2 of about 128 bits
+# and k * P computed as k1 * P + k2 * phi(P) with half the doublings.
+_GLV_LAMBDA = 0x5363ad4cc05c30e0a5261c028812645a122e22ea20816678df02967c1b23bd72
+_GLV_BETA = 0x7ae96a2b657c07106e64479eac3434e99cf0497512f58995c1396c28719501ee
+
+# Short basis of the lattice {(a, b) : a + b * lambda = 0 (mod n)}
+_GLV_A1 = 0x3086d221a7d46bcde86c90e49284eb15
+_GLV_B1 = -0xe4437ed6010e88286f547fa90abfe4c3
+_GLV_A2 = 0x114ca50f7a8e2f3f657c1108d9d44cfd8
+_GLV_B2 = 0x3086d221a7d46bcde86c90e49284eb15
+
+def _glv_split(k: int) -> tuple:
+    c1 = (_GLV_B2 * k + S256_N // 2) // S256_N
+    c2 = (-_GLV_B1 * k + S256_N // 2) // S256_N
+
+    k1 = k - c1 * _GLV_A1 - c2 * _GLV_A2
+    k2 = -c1 * _GLV_B1 - c2 * _GLV_B2
+
+    return (k1, k2)
+
+def _endomorphism_table(table: list) -> list:
+    return [(_GLV_BETA * x % S256_PRIME, y) for x, y in table]
+
+def _glv_terms(k: int, table: list, w: int, endo_table: list = None) -> list:
+    if endo_table is None:
+        endo_table = _endomorphism_table(table)
+
+    k1, k2 = _glv_split(k)
+
+    return [(k1, table, w), (k2, endo_table, w)]
+
+def _glv_multiply(x: int, y: int, coef: int) -> tuple:
+    table = _odd_multiples(x, y, _P_WNAF_WINDOW)
+
+    return _jacobian_multi_multiply(_glv_terms(coef, table, _P_WNAF_WINDOW))
+
 ################################################################
 # SECP256K1 & ECDSA implementation
 ################################################################
@@ -139,6 +270,250 @@ S256_CURVE_A = 0
 S256_CURVE_B = 7
 S256_N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
 
+################################################################
+# SECP256K1 JACOBIAN COORDINATES
+################################################################
+
+# Points are (X, Y, Z) tuples of ints representing the affine point
+# (X / Z^2, Y / Z^3). Z == 0 is the point at infinity. Doubling and addition
+# need no modular inverse, only the final conversion to affine does.
+
+_JACOBIAN_INFINITY = (0, 1, 0)
+
+def _jacobian_double(p: tuple) -> tuple:
+    x1, y1, z1 = p
+
+    if z1 == 0 or y1 == 0:
+        return _JACOBIAN_INFINITY
+
+    # dbl-2009-l (a = 0)
+    a = x1 * x1 % S256_PRIME
+    b = y1 * y1 % S256_PRIME
+    c = b * b % S256_PRIME
+    d = 2 * ((x1 + b) ** 2 - a - c) % S256_PRIME
+    e = 3 * a % S256_PRIME
+    f = e * e % S256_PRIME
+
+    x3 = (f - 2 * d) % S256_PRIME
+    y3 = (e * (d - x3) - 8 * c) % S256_PRIME
+    z3 = 2 * y1 * z1 % S256_PRIME
+
+    return (x3, y3, z3)
+
+def _jacobian_add(p: tuple, q: tuple) -> tuple:
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+
+    if z1 == 0:
+        return q
+
+    if z2 == 0:
+        return p
+
+    # add-1998-cmo-2 (12M + 4S)
+    z1z1 = z1 * z1 % S256_PRIME
+    z2z2 = z2 * z2 % S256_PRIME
+    u1 = x1 * z2z2 % S256_PRIME
+    u2 = x2 * z1z1 % S256_PRIME
+    s1 = y1 * z2 * z2z2 % S256_PRIME
+    s2 = y2 * z1 * z1z1 % S256_PRIME
+
+    h = (u2 - u1) % S256_PRIME
+    r = (s2 - s1) % S256_PRIME
+
+    if h == 0:
+        if r == 0:
+            return _jacobian_double(p)
+
+        return _JACOBIAN_INFINITY
+
+    hh = h * h % S256_PRIME
+    hhh = h * hh % S256_PRIME
+    v = u1 * hh % S256_PRIME
+
+    x3 = (r * r - hhh - 2 * v) % S256_PRIME
+    y3 = (r * (v - x3) - s1 * hhh) % S256_PRIME
+    z3 = z1 * z2 * h % S256_PRIME
+
+    return (x3, y3, z3)
+
+def _jacobian_add_affine(p: tuple, x2: int, y2: int) -> tuple:
+    # Mixed addition, q = (x2, y2, 1)
+    x1, y1, z1 = p
+
+    if z1 == 0:
+        return (x2, y2, 1)
+
+    z1z1 = z1 * z1 % S256_PRIME
+    u2 = x2 * z1z1 % S256_PRIME
+    s2 = y2 * z1 * z1z1 % S256_PRIME
+
+    h = (u2 - x1) % S256_PRIME
+    r = (s2 - y1) % S256_PRIME
+
+    if h == 0:
+        if r == 0:
+            return _jacobian_double(p)
+
+        return _JACOBIAN_INFINITY
+
+    hh = h * h % S256_PRIME
+    hhh = h * hh % S256_PRIME
+    v = x1 * hh % S256_PRIME
+
+    x3 = (r * r - hhh - 2 * v) % S256_PRIME
+    y3 = (r * (v - x3) - y1 * hhh) % S256_PRIME
+    z3 = z1 * h % S256_PRIME
+
+    return (x3, y3, z3)
+
+def _jacobian_to_affine(p: tuple) -> tuple:
+    x, y, z = p
+
+    if z == 0:
+        return (None, None)
+
+    z_inv = pow(z, -1, S256_PRIME)
+    z_inv2 = z_inv * z_inv % S256_PRIME
+
+    return (x * z_inv2 % S256_PRIME, y * z_inv2 * z_inv % S256_PRIME)
+
+def _batch_inverse(values: list, modulus: int) -> list:
+    # Montgomery's trick: inverts every (non-zero) value with a single pow()
+    prefix = []
+    acc = 1
+
+    for v in values:
+        prefix.append(acc)
+        acc = acc * v % modulus
+
+    acc_inv = pow(acc, -1, modulus)
+    out = [0] * len(values)
+
+    for i in range(len(values) - 1, -1, -1):
+        out[i] = acc_inv * prefix[i] % modulus
+        acc_inv = acc_inv * values[i] % modulus
+
+    return out
+
+def _jacobian_batch_to_affine(points: list) -> list:
+    inverses = _batch_inverse([p[2] for p in points], S256_PRIME)
+    out = []
+
+    for (x, y, _), z_inv in zip(points, inverses):
+        z_inv2 = z_inv * z_inv % S256_PRIME
+        out.append((x * z_inv2 % S256_PRIME, y * z_inv2 * z_inv % S256_PRIME))
+
+    return out
+
+################################################################
+# FIXED-BASE MULTIPLICATION TABLE FOR S256_G
+################################################################
+
+# table[i][j - 1] = j * 2^(8 * i) * G in affine coordinates, so k * G is the sum
+# of one table entry per non-zero byte of k and needs no doublings at all.
+_G_TABLE_WINDOW = 8
+_G_TABLE_WINDOWS = 256 // _G_TABLE_WINDOW
+_G_TABLE_SIZE = (1 << _G_TABLE_WINDOW) - 1
+
+_g_table = None
+_g_table_lock = threading.Lock()
+_g_table_cache_path = None
+
+def set_generator_table_cache(path: str):
+    global _g_table_cache_path
+    _g_table_cache_path = path
+
+def _build_generator_table(gx: int, gy: int) -> list:
+    points = []
+    base = (gx, gy, 1)
+
+    for _ in range(_G_TABLE_WINDOWS):
+        current = base
+        points.append(current)
+
+        for _ in range(_G_TABLE_SIZE - 1):
+            current = _jacobian_add(current, base)
+            points.append(current)
+
+        base = _jacobian_add(current, base)
+
+    affine = _jacobian_batch_to_affine(points)
+    return [affine[i * _G_TABLE_SIZE:(i + 1) * _G_TABLE_SIZE] for i in range(_G_TABLE_WINDOWS)]
+
+def _serialize_generator_table(table: list) -> bytes:
+    data = b"".join(x.to_bytes(32, "big") + y.to_bytes(32, "big") for window in table for (x, y) in window)
+    return hashlib.sha256(data).digest() + data
+
+def _parse_generator_table(raw: bytes, gx: int, gy: int) -> list:
+    if len(raw) != 32 + _G_TABLE_WINDOWS * _G_TABLE_SIZE * 64:
+        raise ValueError("Invalid generator table size")
+
+    checksum, data = raw[:32], raw[32:]
+
+    if hashlib.sha256(data).digest() != checksum:
+        raise ValueError("Invalid generator table checksum")
+
+    points = [
+        (int.from_bytes(data[i:i + 32], "big"), int.from_bytes(data[i + 32:i + 64], "big"))
+        for i in range(0, len(data), 64)
+    ]
+
+    if points[0] != (gx, gy):
+        raise ValueError("Generator table does not start with the generator point")
+
+    return [points[i * _G_TABLE_SIZE:(i + 1) * _G_TABLE_SIZE] for i in range(_G_TABLE_WINDOWS)]
+
+def _load_generator_table(gx: int, gy: int) -> list:
+    path = _g_table_cache_path
+
+    if path is not None and os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                return _parse_generator_table(f.read(), gx, gy)
+        except (OSError, ValueError):
+            pass
+
+    table = _build_generator_table(gx, gy)
+
+    if path is not None:
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(_serialize_generator_table(table))
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    return table
+
+def _generator_table() -> list:
+    global _g_table
+
+    if _g_table is None:
+        with _g_table_lock:
+            if _g_table is None:
+                _g_table = _load_generator_table(S256_G.x.num, S256_G.y.num)
+
+    return _g_table
+
+def _generator_multiply(coef: int) -> tuple:
+    table = _generator_table()
+    result = _JACOBIAN_INFINITY
+    i = 0
+
+    while coef:
+        byte = coef & _G_TABLE_SIZE
+
+        if byte:
+            x, y = table[i][byte - 1]
+            result = _jacobian_add_affine(result, x, y)
+
+        coef >>= _G_TABLE_WINDOW
+        i += 1
+
+    return result
+
 class S256Field(FieldElement):
     def __init__(self, num: int, prime: int = None):
         super().__init__(num = num, prime=S256_PRIME)
@@ -149,15 +524,50 @@ class S256Field(FieldElement):
     def __repr__(self) -> str:
         return "S256Field({:x})".format(self.num).zfill(64)
 
+_S256_A = S256Field(S256_CURVE_A)
+_S256_B = S256Field(S256_CURVE_B)
+
+def _s256_on_curve(x: int, y: int) -> bool:
+    return (y * y - x * x * x - S256_CURVE_B) % S256_PRIME == 0
+
 class S256Point(Point):
     def __init__(self, x, y, a = None, b = None):
-        a = S256Field(S256_CURVE_A)
-        b = S256Field(S256_CURVE_B)
+        self.a = _S256_A
+        self.b = _S256_B
 
         if type(x) == int:
-            super().__init__(x=S256Field(x), y=S256Field(y), a=a, b=b)
+            x = S256Field(x)
+            y = S256Field(y)
+
+        self.x = x
+        self.y = y
+
+        if self.x is None and self.y is None:
+            return
+
+        if not _s256_on_curve(x.num, y.num):
+            raise ValueError(f"The point ({x}, {y}) is not on the curve")
+
+    @classmethod
+    def _from_affine(cls, x: int, y: int):
+        # Wraps a result of the raw int arithmetic, which is on the curve by
+        # construction, without re-checking the curve equation
+        point = cls.__new__(cls)
+        point.a = _S256_A
+        point.b = _S256_B
+
+        if x is None:
+            point.x = None
+            point.y = None
         else:
-            super().__init__(x=x, y=y, a=a, b=b)
+            point.x = S256Field(x)
+            point.y = S256Field(y)
+
+        return point
+
+    @classmethod
+    def _from_jacobian(cls, p: tuple):
+        return cls._from_affine(*_jacobian_to_affine(p))
 
     def __repr__(self) -> str:
         if self.x is None:
@@ -165,23 +575,112 @@ class S256Point(Point):
 
         return f"S256Point({self.x}, {self.y})"
 
+    def sec(self, compressed: bool = True) -> bytes:
+        if self.x is None:
+            raise ValueError("Point at infinity has no SEC encoding")
+
+        if compressed:
+            return (b"\x03" if self.y.num & 1 else b"\x02") + self.x.num.to_bytes(32, "big")
+
+        return b"\x04" + self.x.num.to_bytes(32, "big") + self.y.num.to_bytes(32, "big")
+
+    @classmethod
+    def parse_sec(cls, data: bytes):
+        if len(data) == 65 and data[0] == 4:
+            return cls(int.from_bytes(data[1:33], "big"), int.from_bytes(data[33:65], "big"))
+
+        if len(data) != 33 or data[0] not in (2, 3):
+            raise ValueError("Invalid SEC public key encoding")
+
+        x = int.from_bytes(data[1:], "big")
+
+        if x >= S256_PRIME:
+            raise ValueError("Invalid SEC public key encoding")
+
+        y = S256Field((x * x * x + S256_CURVE_B) % S256_PRIME).sqrt().num
+
+        if not _s256_on_curve(x, y):
+            raise ValueError("Invalid SEC public key: x is not on the curve")
+
+        if (y & 1) != (data[0] & 1):
+            y = S256_PRIME - y
+
+        return cls._from_affine(x, y)
+
+    def __add__(self, other):
+        if not isinstance(other, S256Point):
+            return super().__add__(other)
+
+        if self.x is None:
+            return other
+
+        if other.x is None:
+            return self
+
+        return self._from_jacobian(_jacobian_add_affine((self.x.num, self.y.num, 1), other.x.num, other.y.num))
+
     def __rmul__(self, coefficient: int):
         coef = coefficient % S256_N
-        return super().__rmul__(coef)
 
-    def verify(self, z, sig) -> bool:
-        s_inv = pow(sig.s, S256_N - 2, S256_N)
-        u = z * s_inv % S256_N
-        v = sig.r * s_inv % S256_N
-        total = u * S256_G + v * self
+        if self.x is None or coef == 0:
+            return self._from_affine(None, None)
 
-        return total.x.num == sig.r
+        if self.x.num == S256_G.x.num and self.y.num == S256_G.y.num:
+            return self._from_jacobian(_generator_multiply(coef))
+
+        return self._from_jacobian(_glv_multiply(self.x.num, self.y.num, coef))
+
+    def verify(self, z, sig) -> bool:
+        return len(batch_verify([(self, z, sig)])) == 0
 
 S256_G = S256Point(
     0x79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798,
     0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8
 )
 
+def batch_verify(items: list) -> list:
+    # items: [(S256Point, z, Signature), ...]
+    # Returns indices of the items whose signature is invalid (empty if all pass)
+    failures = []
+    pending = []
+
+    for i, (point, z, sig) in enumerate(items):
+        if point.x is None or not (0 < sig.r < S256_PRIME) or not (0 < sig.s < S256_N):
+            failures.append(i)
+        else:
+            pending.append(i)
+
+    # One modular inverse for every s
+    s_invs = _batch_inverse([items[i][2].s for i in pending], S256_N)
+    g_table = _generator_odd_multiples()
+    g_endo_table = _generator_endo_odd_multiples()
+    point_tables = {}
+
+    for i, s_inv in zip(pending, s_invs):
+        point, z, sig = items[i]
+        u = z * s_inv % S256_N
+        v = sig.r * s_inv % S256_N
+
+        # Keys signing several items share their precomputed tables
+        key = (point.x.num, point.y.num)
+        if key not in point_tables:
+            table = _odd_multiples(key[0], key[1], _P_WNAF_WINDOW)
+            point_tables[key] = (table, _endomorphism_table(table))
+
+        table, endo_table = point_tables[key]
+
+        x, y, z3 = _jacobian_multi_multiply(
+            _glv_terms(u, g_table, _G_WNAF_WINDOW, g_endo_table) +
+            _glv_terms(v, table, _P_WNAF_WINDOW, endo_table)
+        )
+
+        # Compare in Jacobian coordinates (x == r * Z^2) instead of inverting Z
+        if z3 == 0 or x != sig.r * z3 * z3 % S256_PRIME:
+            failures.append(i)
+
+    failures.sort()
+    return failures
+
 class Signature:
     def __init__(self, r, s):
         self.r = r
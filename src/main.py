@@ -1,11 +1,13 @@
 import argparse
 import json
 import os
+import time
 
 import logger
 from exception_handler import handle_exception
 
 MAIN_LOGGER = None
+NODE = None
 
 DEFAULT_CONFIG = {
     "colored_output": False,
@@ -16,7 +18,16 @@ DEFAULT_CONFIG = {
     "server_ip": "0.0.0.0",  # All interfaces
     "server_port": 47685,
     "logs_directory": None,
-    "debug_messages": False
+    "debug_messages": False,
+    "mining_workers": 1,  # 0 means one worker per CPU core
+    "mempool_max_transactions": 50000,
+    "mempool_max_size": 64 * 1024 * 1024,  # bytes
+    "resident_blocks": 100,
+    "block_cache_size": 1000,
+    "tx_index": False,
+    "address_index": False,
+    "verification_workers": 1,  # 0 means one worker per CPU core
+    "network_backend": "asyncio"  # "asyncio" or "threads"
 }
 
 def is_valid_address(address: str) -> tuple:
@@ -74,6 +85,11 @@ def load_config():
             if CONFIG[x] is not None:
                 CONFIG[x] = os.path.abspath(CONFIG[x])
 
+    if CONFIG["network_backend"] not in ("asyncio", "threads"):
+        print("ERROR: Failed to parse configuration file!")
+        print(f"       Bad value for key network_backend (should be \"asyncio\" or \"threads\", got \"{CONFIG['network_backend']}\")")
+        raise SystemExit
+
     for tn_addr in CONFIG["trusted_nodes"]:
         chk = is_valid_address(tn_addr)
         if not chk[0]:
@@ -114,6 +130,8 @@ def log_config():
 def main():
     global SERVER
     global CLIENT
+    global NODE
+    global BLOCKCHAIN
 
     MAIN_LOGGER.info("Starting node...")
     MAIN_LOGGER.info("""
@@ -129,21 +147,59 @@ def main():
 
     log_config()
 
-    import server
-    if CONFIG["server_port"]:
-        SERVER = server.Server(port=CONFIG["server_port"])
-    else:
-        SERVER = server.Server()
+    if not os.path.exists(CONFIG["data_directory"]):
+        os.makedirs(CONFIG["data_directory"])
+
+    import ecc
+    ecc.set_generator_table_cache(os.path.join(CONFIG["data_directory"], "s256_g_table.bin"))
+
+    import blockchain
+    import storage
+    BLOCKCHAIN = blockchain.Blockchain(
+        mining_workers=CONFIG["mining_workers"],
+        mempool_max_transactions=CONFIG["mempool_max_transactions"],
+        mempool_max_size=CONFIG["mempool_max_size"],
+        store=storage.BlockStore(os.path.join(CONFIG["data_directory"], "blocks")),
+        resident_blocks=CONFIG["resident_blocks"],
+        block_cache_size=CONFIG["block_cache_size"],
+        tx_index=storage.TxIndex(os.path.join(CONFIG["data_directory"], "txindex.sqlite")) if CONFIG["tx_index"] else None,
+        address_index=storage.AddressIndex(os.path.join(CONFIG["data_directory"], "addressindex.sqlite")) if CONFIG["address_index"] else None,
+        verification_workers=CONFIG["verification_workers"]
+    )
+    MAIN_LOGGER.info(f"Loaded {len(BLOCKCHAIN.chain)} blocks from disk")
+
+    import protocol
 
-    SERVER.start()
+    if CONFIG["network_backend"] == "threads":
+        # Legacy thread-per-connection networking
+        import server
+        if CONFIG["server_port"]:
+            SERVER = server.Server(port=CONFIG["server_port"])
+        else:
+            SERVER = server.Server()
+
+        SERVER.start()
 
-    import client
-    CLIENT = client.Client()
+        import client
+        CLIENT = client.Client()
 
-    client.connect_to_trusted_nodes(CLIENT, CONFIG["trusted_nodes"].copy(), CONFIG["max_servers"])
+        protocol.setup(BLOCKCHAIN, lambda: SERVER._clients + CLIENT._servers)
+        client.connect_to_trusted_nodes(CLIENT, CONFIG["trusted_nodes"].copy(), CONFIG["max_servers"])
+    else:
+        import network
+        NODE = network.Node(
+            addr=CONFIG["server_ip"],
+            port=CONFIG["server_port"],
+            max_clients=CONFIG["max_clients"],
+            max_servers=CONFIG["max_servers"]
+        )
+
+        protocol.setup(BLOCKCHAIN, lambda: list(NODE.peers))
+        NODE.start()
+        NODE.connect_to_trusted_nodes(CONFIG["trusted_nodes"])
 
     while True:
-        pass
+        time.sleep(1)
 
 if __name__ == "__main__":
     # Setup argparse
@@ -200,6 +256,11 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         MAIN_LOGGER.info("Got KeyboardInterrupt")
         MAIN_LOGGER.info("Stopping node...")
-        SERVER.close()
-        CLIENT.close()
+        if NODE is not None:
+            NODE.close()
+        else:
+            SERVER.close()
+            CLIENT.close()
+
+        BLOCKCHAIN.close()
         raise SystemExit
@@ -0,0 +1,334 @@
+import asyncio
+import random
+import threading
+
+import logger
+import protocol
+from exception_handler import handle_exception
+
+_logger = logger.Logger("NETWORK")
+
+HANDSHAKE_TIMEOUT = 3
+CONNECT_ATTEMPTS = 3
+
+################################################################
+# PEER CONNECTION
+################################################################
+
+class Peer(asyncio.BufferedProtocol):
+    # asyncio counterpart of connection.ConnHandler; protocol.handle_message
+    # only relies on .logger, .addr, .send(), .send_frame() and .post(). The event loop reads straight
+    # into the FrameDecoder buffer and frames are dispatched as memoryviews.
+    def __init__(self, node, inbound: bool):
+        self.node = node
+        self.inbound = inbound
+        self.transport = None
+        self.addr = None
+        self.logger = None
+
+        self.decoder = protocol.FrameDecoder()
+        # Inventory (tx/block hashes) this peer has announced or been sent
+        self.known_inventory = protocol.RollingBloomFilter()
+        # Frames wait here while the transport's own buffer is above its high watermark
+        self.send_queue = protocol.SendQueue()
+        self.paused = False
+        self._stall_timer = None  # disconnects the peer if a pause lasts too long
+        self._flush_scheduled = False
+        # Resolved with the first frame, which is always the handshake message
+        self.handshake = node.loop.create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")[:2]
+        self.logger = logger.Logger(f"CONN/{self.addr[0]}:{self.addr[1]}")
+
+        transport.set_write_buffer_limits(high=protocol.SEND_QUEUE_HIGH_WATERMARK, low=protocol.SEND_QUEUE_LOW_WATERMARK)
+
+        if self.inbound:
+            self.node.loop.create_task(self.node._on_accept(self))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.buffer()
+
+    def buffer_updated(self, nbytes: int):
+        self.decoder.feed(nbytes)
+
+        try:
+            for message in self.decoder.frames():
+                if not self.handshake.done():
+                    self.handshake.set_result(str(message, "utf-8"))
+                    continue
+
+                try:
+                    protocol.handle_message(self, message)
+                except protocol.InvalidMessageReceived as err:
+                    self.logger.error(
+                        "Received invalid message message from another peer:" +
+                        f"    {err}" +
+                        "    Ignoring."
+                    )
+        except (protocol.InvalidMessageReceived, UnicodeDecodeError) as err:
+            # Broken framing, the stream can't be resynchronized
+            self.logger.error(f"Received invalid frame from another peer: {err} Disconnecting.")
+            self.close()
+
+    def connection_lost(self, exc):
+        if not self.handshake.done():
+            # None tells the pending handshake that the peer went away
+            self.handshake.set_result(None)
+        elif self in self.node.peers:
+            self.logger.warn("Connection has been closed by another peer.")
+
+        self._cancel_stall_timer()
+        self.node._remove_peer(self)
+
+    def pause_writing(self):
+        # The transport buffer crossed the high watermark; queue until it drains
+        self.paused = True
+        self._cancel_stall_timer()
+        self._stall_timer = self.node.loop.call_later(protocol.SEND_STALL_TIMEOUT, self._check_stalled)
+
+    def resume_writing(self):
+        self.paused = False
+        self._cancel_stall_timer()
+        self._flush()
+
+    def _cancel_stall_timer(self):
+        if self._stall_timer is not None:
+            self._stall_timer.cancel()
+            self._stall_timer = None
+
+    def _check_stalled(self):
+        self._stall_timer = None
+
+        if self.paused and not self.transport.is_closing():
+            self.logger.warn("Peer is not reading its messages. Disconnecting.")
+            self.close(abort=True)
+
+    def _flush(self):
+        self._flush_scheduled = False
+
+        if self.paused or self.transport.is_closing():
+            return
+
+        frames = self.send_queue.take_all()
+        if frames:
+            self.transport.writelines(frames)
+
+    def _enqueue(self, frame: bytes):
+        # Must be called on the event loop
+        if self.transport.is_closing():
+            return
+
+        if not self.send_queue.put(frame):
+            self.logger.warn("Send queue is full. Disconnecting.")
+            self.close(abort=True)
+            return
+
+        if not self._flush_scheduled and not self.paused:
+            # Frames queued during this loop iteration go out in one writelines call
+            self._flush_scheduled = True
+            self.node.loop.call_soon(self._flush)
+
+    def write_msg(self, message: str):
+        # Must be called on the event loop
+        self._enqueue(protocol.frame_msg(message))
+
+    def send_frame(self, frame: bytes):
+        # Safe to call from any thread
+        self.node.loop.call_soon_threadsafe(self._enqueue, frame)
+
+    def send(self, message: str):
+        # Safe to call from any thread
+        self.send_frame(protocol.frame_msg(message))
+
+    def post(self, callback, *args):
+        # Runs callback(*args) on the event loop; safe to call from any thread
+        self.node.loop.call_soon_threadsafe(callback, *args)
+
+    def close(self, abort: bool = False):
+        # abort drops unsent data instead of waiting for a stuck peer to read it
+        if self.transport is None:
+            return
+
+        self._cancel_stall_timer()
+
+        if abort:
+            self.transport.abort()
+        elif not self.transport.is_closing():
+            self.transport.close()
+
+################################################################
+# NODE (SERVER + CLIENT ON ONE EVENT LOOP)
+################################################################
+
+def _split_node_address(node: str) -> tuple:
+    if ":" in node:
+        x = node.split(":")
+        return (x[0], int(x[1]))
+
+    return (node, 47685)
+
+class Node:
+    # Accepts inbound peers and dials outbound ones on a single asyncio event
+    # loop running in a background thread; idle peers cost no CPU.
+    def __init__(self, addr: str = "0.0.0.0", port: int = 47685, max_clients: int = 5, max_servers: int = 10):
+        self.address = (addr, port)
+        self.max_clients = max_clients
+        self.max_servers = max_servers
+
+        self.peers = []
+        self._handshaking = 0  # inbound peers accepted but not handshaked yet
+        self.loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    @handle_exception(_logger)
+    def start(self):
+        self._thread.start()
+        self._submit(self._serve())
+
+    async def _serve(self):
+        _logger.info("Starting server...")
+
+        while self._server is None:
+            try:
+                self._server = await self.loop.create_server(lambda: Peer(self, inbound=True), self.address[0], self.address[1])
+            except OSError:
+                _logger.error(f"Unable to bind address {self.address[0]}:{self.address[1]}! Retrying in 5 seconds...")
+                await asyncio.sleep(5)
+
+        _logger.ok(f"Bound address: {self.address[0]}" + (" (all interfaces)" if self.address[0] == "0.0.0.0" else "") + f" and port: {self.address[1]}")
+        _logger.info("Listening for connections...")
+
+    def _count(self, inbound: bool) -> int:
+        return len([p for p in self.peers if p.inbound == inbound])
+
+    def _remove_peer(self, peer: Peer):
+        if peer in self.peers:
+            self.peers.remove(peer)
+
+    async def _on_accept(self, peer: Peer):
+        addr = peer.addr
+
+        # Peers still handshaking count too, or simultaneous connections would all fit
+        if self._count(inbound=True) + self._handshaking >= self.max_clients:
+            _logger.warn(f"Connection from {addr[0]}:{addr[1]} rejected: too many clients")
+            peer.close()
+            return
+
+        self._handshaking += 1
+
+        try:
+            peer.write_msg(protocol.welcome_message())
+
+            try:
+                response = await asyncio.wait_for(asyncio.shield(peer.handshake), HANDSHAKE_TIMEOUT)
+            except asyncio.TimeoutError:
+                response = False
+        finally:
+            self._handshaking -= 1
+
+        if response is None:
+            (accept_bool, reject_reason) = (False, "Client disconnected")
+        elif response is False:
+            (accept_bool, reject_reason) = (False, "Client response timeout")
+        else:
+            (accept_bool, reject_reason) = protocol.check_welcome_response(response)
+
+        if not accept_bool:
+            _logger.warn(f"Connection from {addr[0]}:{addr[1]} rejected: {reject_reason}")
+            peer.close()
+            return
+
+        _logger.ok(f"Connection from {addr[0]}:{addr[1]} accepted!")
+        self.peers.append(peer)
+        protocol.on_connected(peer)
+
+    async def _connect(self, addr: str, port: int) -> bool:
+        for trynum in range(1, CONNECT_ATTEMPTS + 1):
+            try:
+                _, peer = await self.loop.create_connection(lambda: Peer(self, inbound=False), addr, port)
+                break
+            except OSError:
+                _logger.error(f"Failed to connect to {addr}:{port}" + ("! Retrying..." if trynum < CONNECT_ATTEMPTS else f" {CONNECT_ATTEMPTS} times!"))
+        else:
+            return False
+
+        try:
+            message = await asyncio.wait_for(asyncio.shield(peer.handshake), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            message = False
+
+        if message is None:
+            (connected, error_message) = (False, "Server disconnected!")
+        elif message is False:
+            (connected, error_message) = (False, "Server response timeout!")
+        else:
+            (connected, error_message) = protocol.check_welcome(message)
+
+        if not connected:
+            peer.write_msg(protocol.welcome_response(False, error_message))
+            peer.close()
+            _logger.error(f"Failed to connect to {addr}:{port}! {error_message}")
+            return False
+
+        peer.write_msg(protocol.welcome_response(True))
+        _logger.ok(f"Successfully connected to {addr}:{port}!")
+
+        self.peers.append(peer)
+        protocol.on_connected(peer)
+
+        return True
+
+    def connect(self, addr: str, port: int = 47685) -> bool:
+        # Blocking helper for callers outside the event loop
+        return self._submit(self._connect(addr, port)).result()
+
+    async def _connect_to_nodes(self, nodes: list):
+        if len(nodes) == 0:
+            _logger.warn("There are no trusted nodes added!")
+            return
+
+        if self.max_servers < len(nodes):
+            _logger.warn("There is more trusted nodes than maximum number of servers!")
+
+        _logger.info("Connecting to trusted nodes...")
+        nodes = nodes.copy()
+        random.shuffle(nodes)
+        success = 0
+
+        # Dial in parallel, topping up from the remaining nodes until max_servers is reached
+        while nodes and success < self.max_servers:
+            batch = nodes[:self.max_servers - success]
+            nodes = nodes[len(batch):]
+
+            results = await asyncio.gather(*(self._connect(*_split_node_address(node)) for node in batch))
+            success += sum(1 for r in results if r)
+
+        if success > 0:
+            _logger.info(f"Successfully connected to {success} trusted node" + ("" if success == 1 else "s") + "...")
+        else:
+            _logger.warn(f"Failed to connect to all of trusted nodes!")
+
+    def connect_to_trusted_nodes(self, nodes: list):
+        self._submit(self._connect_to_nodes(nodes))
+
+    async def _close(self):
+        if self._server is not None:
+            self._server.close()
+
+        for peer in list(self.peers):
+            peer.close()
+
+    @handle_exception(_logger)
+    def close(self):
+        self._submit(self._close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
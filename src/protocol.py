@@ -2,11 +2,34 @@ import socket
 import json
 import time
 import struct
+import collections
+import hashlib
+import math
+import secrets
+import threading
+import functools
+import weakref
+import concurrent.futures
 
 import blockchain
 
 USER_AGENT = "FuzionCoin/v0.0.1/PyFuzc"
 
+# Upper bound for a single framed message; larger length prefixes are treated as a protocol violation
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+
+# Per-peer outbound queue limits. Above the high watermark a peer is considered
+# backed up; if it doesn't drain below the low watermark within
+# SEND_STALL_TIMEOUT seconds, or the queue would exceed SEND_QUEUE_MAX_SIZE,
+# the peer is disconnected.
+SEND_QUEUE_MAX_SIZE = 2 * MAX_MESSAGE_SIZE
+SEND_QUEUE_HIGH_WATERMARK = 4 * 1024 * 1024
+SEND_QUEUE_LOW_WATERMARK = 1024 * 1024
+SEND_STALL_TIMEOUT = 30
+
+# Max buffers handed to a single sendmsg call
+SEND_MAX_IOV = 64
+
 class DisconnectedError(Exception):
     pass
 
@@ -17,10 +40,22 @@ class InvalidMessageReceived(Exception):
 # MESSAGING SYSTEM
 ################################################################
 
-def send_msg(conn, msg):
+def frame_msg(msg: str) -> bytes:
     msg = msg.encode("utf-8")
-    msg = struct.pack(">I", len(msg)) + msg
-    conn.sendall(msg)
+    return struct.pack(">I", len(msg)) + msg
+
+# Transactions, blocks and headers travel as binary frames: one type byte
+# followed by their codec serialization. JSON messages always start with "{",
+# so the first byte of a payload tells the two apart.
+MSG_TX = 0x01
+MSG_BLOCK = 0x02
+MSG_HEADERS = 0x03
+
+def frame_binary(msg_type: int, payload: bytes) -> bytes:
+    return struct.pack(">IB", len(payload) + 1, msg_type) + payload
+
+def send_msg(conn, msg):
+    conn.sendall(frame_msg(msg))
 
 def recv_msg(conn) -> str:
     try:
@@ -34,47 +69,274 @@ def recv_msg(conn) -> str:
         raise DisconnectedError
 
     msglen = struct.unpack(">I", raw_msglen)[0]
-    return recvall(conn, msglen).decode("utf-8")
 
-def recvall(conn, n):
-    data = b""
-    while len(data) < n:
-        packet = conn.recv(n - len(data))
+    if msglen > MAX_MESSAGE_SIZE:
+        raise InvalidMessageReceived(f"Message too large ({msglen} bytes)")
+
+    return str(recvall(conn, msglen), "utf-8")
+
+def recvall(conn, n) -> bytearray:
+    # Reads straight into one preallocated buffer instead of concatenating packets
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+
+    while received < n:
+        packet_len = conn.recv_into(view[received:])
 
-        if not packet:
+        if not packet_len:
             # Disconnected
             raise DisconnectedError
 
-        data += packet
+        received += packet_len
+
     return data
 
-def broadcast(msg: str, server, client):
-    for conn in server._clients:
-        send_msg(conn, msg)
+class FrameDecoder:
+    # Incremental decoder for the ">I" length-prefixed stream. Socket reads land
+    # directly in a reusable bytearray (recv_into / BufferedProtocol.get_buffer)
+    # and every complete frame is handed out as a memoryview into that buffer,
+    # so a payload is never copied on its way to the parser. A view is only
+    # valid until the next call to buffer(), which may compact or replace it.
+    def __init__(self, initial_size: int = 64 * 1024, max_message_size: int = None):
+        self.max_message_size = MAX_MESSAGE_SIZE if max_message_size is None else max_message_size
+
+        self._buf = bytearray(initial_size)
+        self._start = 0  # first unconsumed byte
+        self._end = 0    # end of received data
+
+    def _needed(self) -> int:
+        # Bytes the frame at the head of the buffer needs in total (0 if unknown yet)
+        if self._end - self._start < 4:
+            return 0
+
+        return 4 + struct.unpack_from(">I", self._buf, self._start)[0]
+
+    def buffer(self, min_free: int = 4096) -> memoryview:
+        # Returns the writable tail of the buffer for the next socket read
+        pending = self._end - self._start
+        needed = self._needed()
+
+        if needed - 4 > self.max_message_size:
+            # frames() rejects it; don't allocate for it
+            needed = 0
+
+        size = max(len(self._buf), needed, pending + min_free)
+
+        if size > len(self._buf):
+            # Grow into a fresh buffer; views handed out earlier keep the old one alive
+            buf = bytearray(size)
+            buf[:pending] = self._buf[self._start:self._end]
+            self._buf = buf
+            self._start, self._end = 0, pending
+        elif len(self._buf) - self._end < min_free or self._start + needed > len(self._buf) or self._start == self._end:
+            # Compact: move the partial frame to the front
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+
+        return memoryview(self._buf)[self._end:]
+
+    def feed(self, n: int):
+        # Marks n bytes written into the last buffer() as received
+        self._end += n
+
+    def recv_from(self, conn: socket.socket) -> int:
+        n = conn.recv_into(self.buffer())
+
+        if not n:
+            raise DisconnectedError
+
+        self.feed(n)
+        return n
+
+    def frames(self):
+        # Yields the payload of every complete frame received so far
+        while True:
+            needed = self._needed()
+
+            if needed == 0:
+                return
+
+            if needed - 4 > self.max_message_size:
+                raise InvalidMessageReceived(f"Message too large ({needed - 4} bytes)")
+
+            if self._end - self._start < needed:
+                return
+
+            payload = memoryview(self._buf)[self._start + 4:self._start + needed]
+            self._start += needed
+
+            yield payload
+
+class SendQueue:
+    # Bounded FIFO of outbound frames. Queued frames are coalesced into one
+    # sendmsg (or writelines) call instead of one send per message.
+    def __init__(self, max_size: int = SEND_QUEUE_MAX_SIZE, high_watermark: int = SEND_QUEUE_HIGH_WATERMARK, low_watermark: int = SEND_QUEUE_LOW_WATERMARK):
+        self.max_size = max_size
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+
+        self.size = 0
+        self.over_high_since = None  # time.monotonic() when the high watermark was crossed
+
+        self._frames = collections.deque()
+        self._offset = 0  # bytes of the first frame already sent
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def _update_watermark(self):
+        if self.over_high_since is None and self.size > self.high_watermark:
+            self.over_high_since = time.monotonic()
+        elif self.over_high_since is not None and self.size <= self.low_watermark:
+            self.over_high_since = None
+
+    def put(self, frame: bytes) -> bool:
+        # False if the frame doesn't fit; the peer should be dropped
+        if self.size + len(frame) > self.max_size:
+            return False
+
+        self._frames.append(frame)
+        self.size += len(frame)
+        self._update_watermark()
 
-    for conn in client._servers:
-        send_msg(conn, msg)
+        return True
+
+    def stalled(self, timeout: float = SEND_STALL_TIMEOUT) -> bool:
+        return self.over_high_since is not None and time.monotonic() - self.over_high_since >= timeout
+
+    def take_all(self) -> list:
+        # Removes and returns every queued frame (for transports with their own buffer)
+        frames = list(self._frames)
+
+        if self._offset:
+            frames[0] = memoryview(frames[0])[self._offset:]
+
+        self._frames.clear()
+        self._offset = 0
+        self.size = 0
+        self._update_watermark()
+
+        return frames
+
+    def send_to(self, conn: socket.socket) -> int:
+        # Sends as much as the (non-blocking) socket accepts in one call
+        if not self._frames:
+            return 0
+
+        buffers = [memoryview(self._frames[0])[self._offset:]]
+        for i in range(1, min(len(self._frames), SEND_MAX_IOV)):
+            buffers.append(self._frames[i])
+
+        try:
+            if hasattr(conn, "sendmsg"):
+                sent = conn.sendmsg(buffers)
+            else:
+                sent = conn.send(b"".join(buffers))
+        except BlockingIOError:
+            return 0
+
+        self._consume(sent)
+        return sent
+
+    def _consume(self, n: int):
+        self.size -= n
+
+        while n > 0:
+            remaining = len(self._frames[0]) - self._offset
+
+            if n < remaining:
+                self._offset += n
+                break
+
+            n -= remaining
+            self._frames.popleft()
+            self._offset = 0
+
+        self._update_watermark()
+
+################################################################
+# KNOWN INVENTORY FILTER
+################################################################
+
+class RollingBloomFilter:
+    # Remembers roughly the last `capacity` inserted items with a small false
+    # positive rate in constant memory. Items go into the newest of three
+    # generations; once it holds capacity / 2 items the oldest generation is
+    # wiped and reused, so between capacity and 1.5 * capacity recent items
+    # are always remembered.
+    GENERATIONS = 3
+
+    def __init__(self, capacity: int = 50000, fp_rate: float = 0.000001):
+        self._per_generation = max(1, capacity // 2)
+
+        # Optimal size for one generation; lookups check every generation, so
+        # each gets a third of the false positive budget
+        p = fp_rate / self.GENERATIONS
+        self._bits = max(64, int(-self._per_generation * math.log(p) / math.log(2) ** 2))
+        self._hashes = max(1, round(self._bits / self._per_generation * math.log(2)))
+
+        self._filters = [bytearray((self._bits + 7) // 8) for _ in range(self.GENERATIONS)]
+        self._current = 0
+        self._count = 0
+
+        # Per-filter key, so colliding items differ from peer to peer
+        self._key = secrets.token_bytes(16)
+
+    def _positions(self, item: bytes):
+        digest = hashlib.blake2b(item, key=self._key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+
+        for i in range(self._hashes):
+            yield (h1 + i * h2) % self._bits
+
+    def add(self, item: bytes):
+        if self._count >= self._per_generation:
+            self._current = (self._current + 1) % self.GENERATIONS
+            self._filters[self._current] = bytearray(len(self._filters[self._current]))
+            self._count = 0
+
+        bits = self._filters[self._current]
+        for pos in self._positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+        self._count += 1
+
+    def __contains__(self, item: bytes) -> bool:
+        positions = list(self._positions(item))
+
+        for bits in self._filters:
+            if all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+                return True
+
+        return False
 
 ################################################################
 # WELCOME MESSAGES (ENSTABILISHING CONNECTION)
 ################################################################
 
-def welcome_message_server(conn: socket.socket) -> tuple:
-    message_content = {
+def welcome_message() -> str:
+    return json.dumps({
         "method": "welcome",
         "ua": USER_AGENT
+    })
+
+def welcome_response(connected: bool, reason: str = None) -> str:
+    response_dict = {
+        "method": "welcome_response",
+        "connected": connected
     }
-    message_content_json = json.dumps(message_content)
-    send_msg(conn, message_content_json)
 
-    response = None
-    start_time = time.time()
+    if connected:
+        response_dict["ua"] = USER_AGENT
+    else:
+        response_dict["reason"] = reason
 
-    while not response:
-        if time.time() - start_time >= 3:
-            return (False, "Client response timeout")
-        response = recv_msg(conn)
+    return json.dumps(response_dict)
 
+def check_welcome_response(response: str) -> tuple:
+    # Server side: decides whether the client's response completes the handshake
     try:
         response_dict = json.loads(response)
     except ValueError:
@@ -91,15 +353,36 @@ def welcome_message_server(conn: socket.socket) -> tuple:
 
     return (True, None)
 
-def welcome_message_client_cancel_connection(conn: socket.socket, reason: str):
-    response_dict = {
-        "method": "welcome_response",
-        "connected": False,
-        "reason": reason,
-    }
+def check_welcome(message: str) -> tuple:
+    # Client side: decides whether client should accept server's user agent
+    try:
+        message_dict = json.loads(message)
+    except ValueError:
+        return (False, "Bad response received! Cannot decode response.")
+
+    if not ("method" in message_dict and message_dict["method"] == "welcome"):
+        return (False, "Bad response received!")
 
-    response_dict_json = json.dumps(response_dict)
-    send_msg(conn, response_dict_json)
+    if not ("ua" in message_dict and message_dict["ua"].split("/")[0] == "FuzionCoin"):
+        return (False, "Server isn't running FuzionCoin node!")
+
+    return (True, None)
+
+def welcome_message_server(conn: socket.socket) -> tuple:
+    send_msg(conn, welcome_message())
+
+    response = None
+    start_time = time.time()
+
+    while not response:
+        if time.time() - start_time >= 3:
+            return (False, "Client response timeout")
+        response = recv_msg(conn)
+
+    return check_welcome_response(response)
+
+def welcome_message_client_cancel_connection(conn: socket.socket, reason: str):
+    send_msg(conn, welcome_response(False, reason))
 
     conn.shutdown(socket.SHUT_RDWR)
     conn.close()
@@ -118,59 +401,623 @@ def welcome_message_client(conn: socket.socket) -> tuple:
 
         message = recv_msg(conn)
 
-    try:
-        message_dict = json.loads(message)
-    except ValueError:
-        r = "Bad response received! Cannot decode response."
-        welcome_message_client_cancel_connection(conn, r)
-        return (False, r)
+    (accepted, r) = check_welcome(message)
 
-    # Decide whether client should accept server's user agent
-    if not ("method" in message_dict and message_dict["method"] == "welcome"):
-        r = "Bad response received!"
-        welcome_message_client_cancel_connection(conn, r)
-        return (False, r)
-
-    if not ("ua" in message_dict and message_dict["ua"].split("/")[0] == "FuzionCoin"):
-        r = "Server isn't running FuzionCoin node!"
+    if not accepted:
         welcome_message_client_cancel_connection(conn, r)
         return (False, r)
 
     # Accept
-    response_dict = {
-        "method": "welcome_response",
-        "connected": True,
-        "ua": USER_AGENT
-    }
-
-    response_dict_json = json.dumps(response_dict)
-    send_msg(conn, response_dict_json)
+    send_msg(conn, welcome_response(True))
 
     return (True, None)
 
+################################################################
+# HEADERS-FIRST CHAIN SYNCHRONIZATION
+################################################################
+
+MAX_HEADERS = 2000          # headers per "headers" message
+MAX_LOCATOR_HASHES = 64
+BLOCK_DOWNLOAD_WINDOW = 16  # blocks in flight per peer
+MAX_BLOCKS_AHEAD = 1024     # bodies downloaded past the next block to connect
+BLOCK_DOWNLOAD_TIMEOUT = 60
+
+class HeaderSync:
+    # Best known header chain that is longer than ours, kept from the height
+    # where it leaves our chain (`fork`), plus block bodies downloaded for it.
+    # Headers are checked for linkage and PoW as they arrive; bodies are only
+    # requested once the headers are known and connected in height order.
+    def __init__(self):
+        self.fork = 0
+        # _headers[_start + i].height == fork + i; headers that joined our chain
+        # are skipped by moving _start and only dropped once they are half the list
+        self._headers = []
+        self._start = 0
+        self.bodies = {}     # height -> Block
+        self.in_flight = {}  # height -> (peer, time of the getdata)
+        self.dropped = weakref.WeakSet()  # peers that sent invalid headers
+        self.lock = threading.RLock()
+
+    def tip(self) -> int:
+        # Length of the best header chain
+        return self.fork + len(self._headers) - self._start
+
+    def header(self, height: int):
+        # Header at fork <= height < tip()
+        return self._headers[self._start + height - self.fork]
+
+    def expects(self, block) -> bool:
+        return self.fork <= block.height < self.tip() and self.header(block.height).hash() == block.hash()
+
+    def reset(self):
+        self._headers = []
+        self._start = 0
+        self.bodies.clear()
+        self.in_flight.clear()
+
+    def drop_peer(self, peer):
+        # Stops syncing with a peer; blocks requested from it go to other peers
+        self.dropped.add(peer)
+
+        for height, (p, _) in list(self.in_flight.items()):
+            if p is peer:
+                del self.in_flight[height]
+
+    def add_headers(self, chain, headers: list) -> bool:
+        # Returns False if the batch doesn't connect to our chain or the best
+        # header chain. Raises InvalidMessageReceived on bad linkage or PoW.
+        height = headers[0].height
+
+        for i, header in enumerate(headers):
+            if header.height != height + i or (i > 0 and header.prev_hash != headers[i - 1].hash()):
+                raise InvalidMessageReceived("(HEADERS) Headers are not linked!")
+
+            if not header.check_pow():
+                raise InvalidMessageReceived(f"(HEADERS) Header {header.height} does not meet the target!")
+
+        # Find what the batch builds on
+        if height == 0:
+            connects = headers[0].prev_hash == bytes(32)
+            from_sync = False
+        elif self.fork < height <= self.tip():
+            connects = self.header(height - 1).hash() == headers[0].prev_hash
+            from_sync = True
+        elif height <= len(chain.chain):
+            connects = chain.chain.header(height - 1).hash() == headers[0].prev_hash
+            from_sync = False
+        else:
+            connects = False
+
+        if not connects:
+            return False
+
+        if from_sync:
+            if height + len(headers) <= max(len(chain.chain), self.tip()):
+                # Not better than what we have or already know
+                return True
+
+            # Requests for heights whose header changed are void
+            for h in list(self.in_flight):
+                if h >= height and not (h - height < len(headers) and h < self.tip() and self.header(h).hash() == headers[h - height].hash()):
+                    del self.in_flight[h]
+
+            # Replace the tail from `height` in place; the part before it is kept
+            del self._headers[self._start + height - self.fork:]
+            self._headers.extend(headers)
+        else:
+            # Skip the part we already have
+            skip = 0
+            while skip < len(headers) and height + skip < len(chain.chain) and chain.chain.header(height + skip).hash() == headers[skip].hash():
+                skip += 1
+
+            height += skip
+
+            if height + len(headers) - skip <= max(len(chain.chain), self.tip()):
+                # Not better than what we have or already know
+                return True
+
+            # Requests for heights whose header changed are void
+            for h in list(self.in_flight):
+                i = h - height + skip
+                if not (skip <= i < len(headers) and self.fork <= h < self.tip() and self.header(h).hash() == headers[i].hash()):
+                    del self.in_flight[h]
+
+            self.fork = height
+            self._headers = headers
+            self._start = skip
+
+        self.bodies = {h: b for h, b in self.bodies.items() if self.expects(b)}
+        self.advance(chain)
+
+        return True
+
+    def advance(self, chain):
+        # Drops headers that have become part of our chain
+        while self.fork < self.tip() and self.fork < len(chain.chain) and chain.chain.header(self.fork).hash() == self.header(self.fork).hash():
+            self.bodies.pop(self.fork, None)
+            self.in_flight.pop(self.fork, None)
+            self._start += 1
+            self.fork += 1
+
+        if self._start > len(self._headers) // 2:
+            del self._headers[:self._start]
+            self._start = 0
+
+        if self.tip() <= len(chain.chain):
+            self.reset()
+            self.fork = len(chain.chain)
+
+    def next_requests(self, peer) -> list:
+        # Heights to fetch from peer, keeping its window full
+        if peer in self.dropped:
+            return []
+
+        now = time.monotonic()
+        busy = sum(1 for p, _ in self.in_flight.values() if p is peer)
+        heights = []
+
+        for height in range(self.fork, min(self.tip(), self.fork + MAX_BLOCKS_AHEAD)):
+            if busy + len(heights) >= BLOCK_DOWNLOAD_WINDOW:
+                break
+
+            if height in self.bodies:
+                continue
+
+            entry = self.in_flight.get(height)
+            if entry is not None and now - entry[1] < BLOCK_DOWNLOAD_TIMEOUT:
+                continue
+
+            self.in_flight[height] = (peer, now)
+            heights.append(height)
+
+        return heights
+
+    def take_connectable(self, chain) -> list:
+        # Consecutive bodies from the fork point, once they make a longer chain
+        blocks = []
+
+        while self.fork + len(blocks) in self.bodies:
+            blocks.append(self.bodies[self.fork + len(blocks)])
+
+        if self.fork + len(blocks) <= len(chain.chain):
+            return []
+
+        for block in blocks:
+            del self.bodies[block.height]
+
+        return blocks
+
+_sync = HeaderSync()
+
+def getheaders_message(locator: list) -> str:
+    return json.dumps({"method": "getheaders", "locator": [h.hex() for h in locator[:MAX_LOCATOR_HASHES]]})
+
+def on_connected(conn_handler):
+    # Called by both networking backends after a successful handshake
+    if _blockchain is not None:
+        conn_handler.send(getheaders_message(_blockchain.locator()))
+
+def _request_blocks(conn_handler):
+    with _sync.lock:
+        items = [inv_item("block", _sync.header(h).hash(), h) for h in _sync.next_requests(conn_handler)]
+
+    if items:
+        conn_handler.send(json.dumps({"method": "getdata", "items": items}))
+
+def _connect_synced(conn_handler):
+    # Runs on the chain worker. Returns our new tip, or None if nothing was connected.
+    # _sync.lock is not held while connecting, so the peer threads keep
+    # handling headers; the single chain worker keeps connections in order.
+    with _sync.lock:
+        blocks = _sync.take_connectable(_blockchain)
+
+    if not blocks:
+        return None
+
+    try:
+        _blockchain.connect_blocks(blocks[0].height, blocks)
+    except ValueError as err:
+        conn_handler.logger.warn(f"Rejected block while syncing: {err}")
+
+        with _sync.lock:
+            _sync.reset()
+
+    with _sync.lock:
+        _sync.advance(_blockchain)
+
+    if len(_blockchain.chain) == 0:
+        return None
+
+    return _blockchain.chain.header(len(_blockchain.chain) - 1)
+
+def _synced(conn_handler, future: concurrent.futures.Future):
+    tip = future.result()
+
+    if tip is not None:
+        conn_handler.logger.info(f"Synced to block {tip.height} ({tip.hash().hex()})")
+        announce("block", tip.hash(), tip.height, source=conn_handler)
+
+    _request_blocks(conn_handler)
+
 ################################################################
 # MESSAGES HANDLER
 ################################################################
 
-def handle_message(conn_handler, message: str):
-    # TODO: this
+# Items requested with getdata are not requested again from another peer
+# unless the first one doesn't deliver within this many seconds
+GETDATA_TIMEOUT = 30
+MAX_INV_ITEMS = 50000
+
+_blockchain = None
+_get_peers = None
+
+# Signature checks and chain updates (add_transactions, add_block,
+# connect_blocks) run on this single thread instead of the peer's thread, so
+# the event loop keeps serving every peer while a block is validated
+_chain_worker = None
+
+_requested = collections.OrderedDict()  # (type, hash) -> time of the getdata
+_requested_lock = threading.Lock()
+
+def setup(chain, get_peers):
+    # chain: the node's blockchain.Blockchain
+    # get_peers: callable returning the connected peers (objects with .send()
+    # and .known_inventory)
+    global _blockchain
+    global _get_peers
+    global _chain_worker
+
+    _blockchain = chain
+    _get_peers = get_peers
+
+    if _chain_worker is None:
+        _chain_worker = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="chain")
+
+    chain.announce = announce
+
+def _on_chain_worker(conn_handler, work, done):
+    # Runs work() on the chain worker, then done(future) back on the peer's
+    # thread (the event loop for network.Peer) through conn_handler.post()
+    future = _chain_worker.submit(work)
+    future.add_done_callback(lambda f: conn_handler.post(done, f))
+
+def inv_item(item_type: str, item_hash: bytes, height: int = None) -> dict:
+    item = {"type": item_type, "hash": item_hash.hex()}
+
+    if height is not None:
+        item["height"] = height
+
+    return item
+
+def announce(item_type: str, item_hash: bytes, height: int = None, source = None):
+    # Sends an inv for a new tx/block to every peer that doesn't know it yet
+    if _get_peers is None:
+        return
+
+    msg = json.dumps({"method": "inv", "items": [inv_item(item_type, item_hash, height)]})
+
+    for peer in _get_peers():
+        if peer is source or item_hash in peer.known_inventory:
+            continue
+
+        peer.known_inventory.add(item_hash)
+        peer.send(msg)
+
+def _have(item: dict) -> bool:
+    item_hash = item["hash"]
+
+    if item["type"] == "tx":
+        # is_confirmed uses the tx index when there is one and recent blocks otherwise
+        return item_hash in _blockchain.mempool or _blockchain.is_confirmed(item_hash)
+
+    height = item["height"]
+
     try:
+        return height < len(_blockchain.chain) and _blockchain.chain.header(height).hash() == item_hash
+    except IndexError:
+        # The chain worker disconnected blocks meanwhile
+        return False
+
+def _request(item: dict) -> bool:
+    # Marks the item as requested; False if another peer was already asked recently
+    key = (item["type"], item["hash"])
+    now = time.monotonic()
+
+    with _requested_lock:
+        while _requested and now - next(iter(_requested.values())) >= GETDATA_TIMEOUT:
+            _requested.popitem(last=False)
+
+        if key in _requested:
+            return False
+
+        _requested[key] = now
+        return True
+
+def _received(item_type: str, item_hash: bytes):
+    with _requested_lock:
+        _requested.pop((item_type, item_hash), None)
+
+def _parse_inv_items(message: dict) -> list:
+    items = message.get("items")
+
+    if not isinstance(items, list) or len(items) > MAX_INV_ITEMS:
+        raise InvalidMessageReceived(f"({message['method'].upper()}) Invalid list of items!")
+
+    out = []
+    for item in items:
+        try:
+            item_type = item["type"]
+            item_hash = bytes.fromhex(item["hash"])
+            height = item.get("height")
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise InvalidMessageReceived(f"({message['method'].upper()}) Invalid item!")
+
+        if len(item_hash) != 32:
+            raise InvalidMessageReceived(f"({message['method'].upper()}) Invalid item hash!")
+
+        if item_type == "tx":
+            out.append({"type": "tx", "hash": item_hash})
+        elif item_type == "block":
+            if not isinstance(height, int) or height < 0:
+                raise InvalidMessageReceived(f"({message['method'].upper()}) Invalid block height!")
+
+            out.append({"type": "block", "hash": item_hash, "height": height})
+        else:
+            raise InvalidMessageReceived(f"({message['method'].upper()}) Invalid type of declared known element!")
+
+    return out
+
+def handle_message(conn_handler, message):
+    # message is either a str or a memoryview payload straight from a FrameDecoder
+    if not isinstance(message, str) and len(message) > 0 and message[0] in _BINARY_HANDLERS:
+        method, handler = _BINARY_HANDLERS[message[0]]
+        conn_handler.logger.debug(f"Received message: {method}")
+
+        if _blockchain is None:
+            return
+
+        # The handler parses straight from the receive buffer
+        handler(conn_handler, memoryview(message)[1:])
+        return
+
+    try:
+        if not isinstance(message, str):
+            message = str(message, "utf-8")
+
         message_dict = json.loads(message)
     except ValueError:
         conn_handler.logger.error("Received invalid message: Can't parse JSON!")
         return
 
-    conn_handler.logger.debug("Received message:")
-    for x, y in message_dict.items():
-        conn_handler.logger.debug(f"  {x}: {y}")
+    if not isinstance(message_dict, dict):
+        raise InvalidMessageReceived("Message is not a JSON object!")
+
+    conn_handler.logger.debug(f"Received message: {message_dict.get('method')}")
+
+    handler = _HANDLERS.get(message_dict.get("method"))
+
+    if handler is None:
+        raise InvalidMessageReceived(f"Unknown method {message_dict.get('method')}!")
+
+    if _blockchain is None:
+        # Networking without a chain (nothing to relay)
+        return
+
+    handler(conn_handler, message_dict)
 
 def handle_inv(conn_handler, message: dict):
-    # TODO: this
-    if message["type"] == "tx":
-        # Transaction
-        pass
-    elif message["type"] == "block":
-        height = message["height"]
-        hash = message["hash"]
-    else:
-        raise InvalidMessageReceived("(INV) Invalid type of declared known element!")
+    wanted = []
+    need_headers = False
+
+    for item in _parse_inv_items(message):
+        conn_handler.known_inventory.add(item["hash"])
+
+        if item["type"] == "block":
+            if item["height"] > len(_blockchain.chain):
+                # We are behind; learn the headers first
+                need_headers = True
+                continue
+
+        if not _have(item) and _request(item):
+            wanted.append(item)
+
+    if need_headers:
+        conn_handler.send(getheaders_message(_blockchain.locator()))
+
+    if wanted:
+        conn_handler.send(json.dumps({
+            "method": "getdata",
+            "items": [inv_item(x["type"], x["hash"], x.get("height")) for x in wanted]
+        }))
+
+def handle_getdata(conn_handler, message: dict):
+    for item in _parse_inv_items(message):
+        if item["type"] == "tx":
+            tx = _blockchain.mempool.get(item["hash"])
+
+            if tx is None and _blockchain.tx_index is not None:
+                tx = _blockchain.find_transaction(item["hash"])
+
+            if tx is None:
+                continue
+
+            data = tx.serialize_binary()
+        else:
+            if not _have(item):
+                continue
+
+            try:
+                block = _blockchain.chain[item["height"]]
+            except IndexError:
+                # Disconnected by the chain worker since _have()
+                continue
+
+            if block.hash() != item["hash"]:
+                continue
+
+            data = block.serialize_binary()
+
+        conn_handler.known_inventory.add(item["hash"])
+        conn_handler.send_frame(frame_binary(MSG_TX if item["type"] == "tx" else MSG_BLOCK, data))
+
+def handle_tx(conn_handler, data: memoryview):
+    try:
+        tx = blockchain.Transaction.parse_binary(data)
+    except ValueError as err:
+        raise InvalidMessageReceived(f"(TX) Invalid transaction: {err}")
+
+    tx_hash = tx.hash()
+    _received("tx", tx_hash)
+    conn_handler.known_inventory.add(tx_hash)
+
+    if tx_hash in _blockchain.mempool:
+        return
+
+    _on_chain_worker(
+        conn_handler,
+        functools.partial(_blockchain.add_transactions, [tx]),
+        functools.partial(_tx_added, conn_handler, tx_hash)
+    )
+
+def _tx_added(conn_handler, tx_hash: bytes, future: concurrent.futures.Future):
+    if len(future.result()) > 0:
+        conn_handler.logger.warn(f"Rejected transaction {tx_hash.hex()}")
+        return
+
+    announce("tx", tx_hash, source=conn_handler)
+
+def handle_block(conn_handler, data: memoryview):
+    # Only the header is decoded until the block is known to be wanted
+    try:
+        header = blockchain.Block.parse_binary_header(data)
+    except ValueError as err:
+        raise InvalidMessageReceived(f"(BLOCK) Invalid block: {err}")
+
+    block_hash = header.hash()
+    _received("block", block_hash)
+    conn_handler.known_inventory.add(block_hash)
+
+    with _sync.lock:
+        synced = _sync.expects(header)
+
+    if synced:
+        try:
+            block = blockchain.Block.parse_binary(data)
+        except ValueError as err:
+            raise InvalidMessageReceived(f"(BLOCK) Invalid block: {err}")
+
+        with _sync.lock:
+            if _sync.expects(block):
+                _sync.in_flight.pop(block.height, None)
+                _sync.bodies[block.height] = block
+
+        _on_chain_worker(
+            conn_handler,
+            functools.partial(_connect_synced, conn_handler),
+            functools.partial(_synced, conn_handler)
+        )
+        return
+
+    try:
+        block = blockchain.parse_block(data)
+    except blockchain.ValidationError as err:
+        conn_handler.logger.warn(f"Rejected block {header.height} ({block_hash.hex()}): {err}")
+        return
+
+    _on_chain_worker(
+        conn_handler,
+        functools.partial(_add_block, block),
+        functools.partial(_block_added, conn_handler, block)
+    )
+
+def _add_block(block):
+    # Runs on the chain worker
+    _blockchain.add_block(block)
+
+    with _sync.lock:
+        _sync.advance(_blockchain)
+
+def _block_added(conn_handler, block, future: concurrent.futures.Future):
+    block_hash = block.hash()
+
+    try:
+        future.result()
+    except blockchain.ValidationError as err:
+        conn_handler.logger.warn(f"Rejected block {block.height} ({block_hash.hex()}): {err}")
+
+        if err.stage == "linkage" and block.height >= len(_blockchain.chain) - 1:
+            # Ahead of us or on another branch; find out through headers
+            conn_handler.send(getheaders_message(_blockchain.locator()))
+
+        return
+    except ValueError as err:
+        conn_handler.logger.warn(f"Rejected block {block.height} ({block_hash.hex()}): {err}")
+        return
+
+    conn_handler.logger.info(f"Added block {block.height} ({block_hash.hex()})")
+    announce("block", block_hash, block.height, source=conn_handler)
+
+def handle_getheaders(conn_handler, message: dict):
+    locator = message.get("locator")
+
+    if not isinstance(locator, list) or len(locator) > MAX_LOCATOR_HASHES:
+        raise InvalidMessageReceived("(GETHEADERS) Invalid locator!")
+
+    try:
+        locator = [bytes.fromhex(h) for h in locator]
+    except (TypeError, ValueError):
+        raise InvalidMessageReceived("(GETHEADERS) Invalid locator hash!")
+
+    headers = _blockchain.headers_after(locator, MAX_HEADERS)
+    conn_handler.send_frame(frame_binary(MSG_HEADERS, blockchain.serialize_headers(headers)))
+
+def handle_headers(conn_handler, data: memoryview):
+    try:
+        headers = blockchain.parse_headers(data, MAX_HEADERS)
+    except ValueError as err:
+        raise InvalidMessageReceived(f"(HEADERS) Invalid headers: {err}")
+
+    if not headers:
+        return
+
+    for header in headers:
+        conn_handler.known_inventory.add(header.hash())
+
+    with _sync.lock:
+        if conn_handler in _sync.dropped:
+            return
+
+        try:
+            connects = _sync.add_headers(_blockchain, headers)
+        except InvalidMessageReceived:
+            _sync.drop_peer(conn_handler)
+            raise
+        except IndexError:
+            # The chain worker disconnected blocks while the batch was matched
+            # against our chain; ask again from where the chain is now
+            conn_handler.send(getheaders_message(_blockchain.locator()))
+            return
+
+        if not connects:
+            conn_handler.logger.debug("Received headers that don't connect to our chain")
+            return
+
+        more = len(headers) == MAX_HEADERS
+
+    if more:
+        # Continue from the last header received; the rest of our locator covers a reorg meanwhile
+        conn_handler.send(getheaders_message([headers[-1].hash()] + _blockchain.locator()))
+
+    _request_blocks(conn_handler)
+
+_HANDLERS = {
+    "inv": handle_inv,
+    "getdata": handle_getdata,
+    "getheaders": handle_getheaders
+}
+
+_BINARY_HANDLERS = {
+    MSG_TX: ("tx", handle_tx),
+    MSG_BLOCK: ("block", handle_block),
+    MSG_HEADERS: ("headers", handle_headers)
+}
@@ -50,6 +50,7 @@ class Server:
                 handler.start()
 
                 self._clients.append(handler)
+                protocol.on_connected(handler)
             else:
                 _logger.warn(f"Connection from {list(addr)[0]}:{list(addr)[1]} rejected: {reject_reason}")
                 conn.close()
@@ -58,6 +59,7 @@ class Server:
     def conn_watchdog(self):
         time.sleep(0.5)
         while self.running:
+            time.sleep(0.5)
             for i in range(len(self._clients)):
                 if not self._clients[i].is_alive():
                     self._clients.pop(i)
@@ -0,0 +1,304 @@
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+
+################################################################
+# APPEND-ONLY BLOCK STORE
+################################################################
+
+# Every record is: header | payload
+# header = magic (4) | payload length (4) | height (8) | block hash (32) | payload crc32 (4)
+RECORD_MAGIC = b"FZCB"
+RECORD_HEADER = struct.Struct(">4sIQ32sI")
+
+SEGMENT_MAX_SIZE = 128 * 1024 * 1024
+
+class BlockStore:
+    # Blocks are appended to segment files (blk00000.dat, blk00001.dat, ...) in
+    # height order. The height/hash index is rebuilt on open by scanning the
+    # record headers; payloads are checksummed only in the last segment, where a
+    # crash can leave a torn or corrupted tail, which is then truncated.
+    def __init__(self, directory: str, sync_interval: int = 16, segment_max_size: int = SEGMENT_MAX_SIZE):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.segment_max_size = segment_max_size
+
+        self._locations = []  # height -> (segment, offset, length) of the payload
+        self._heights = {}    # block hash -> height
+        self._maps = {}       # segment -> mmap
+        self._unsynced = 0
+        self._lock = threading.RLock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._segment = self._recover()
+        self._file = open(self._segment_path(self._segment), "ab")
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"blk{segment:05d}.dat")
+
+    def _recover(self) -> int:
+        segment = 0
+
+        while os.path.exists(self._segment_path(segment)):
+            path = self._segment_path(segment)
+            # Only the last segment can hold a torn write, so only its payloads are checksummed
+            last = not os.path.exists(self._segment_path(segment + 1))
+            valid_end = self._scan_segment(segment, check_payloads=last)
+
+            if valid_end < os.path.getsize(path):
+                # Torn or corrupted tail: drop it and everything written after it
+                with open(path, "r+b") as f:
+                    f.truncate(valid_end)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                later = segment + 1
+                while os.path.exists(self._segment_path(later)):
+                    os.remove(self._segment_path(later))
+                    later += 1
+
+                return segment
+
+            if not os.path.exists(self._segment_path(segment + 1)):
+                return segment
+
+            segment += 1
+
+        return 0
+
+    def _scan_segment(self, segment: int, check_payloads: bool) -> int:
+        # Indexes every complete record and returns the offset after the last one.
+        # Without check_payloads only record headers are read and payloads skipped.
+        offset = 0
+        path = self._segment_path(segment)
+        file_size = os.path.getsize(path)
+
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+
+                if len(header) < RECORD_HEADER.size:
+                    return offset
+
+                magic, length, height, block_hash, crc = RECORD_HEADER.unpack(header)
+
+                if magic != RECORD_MAGIC or height != len(self._locations):
+                    return offset
+
+                if offset + RECORD_HEADER.size + length > file_size:
+                    return offset
+
+                if check_payloads:
+                    if zlib.crc32(f.read(length)) != crc:
+                        return offset
+                else:
+                    f.seek(length, os.SEEK_CUR)
+
+                self._locations.append((segment, offset + RECORD_HEADER.size, length))
+                self._heights[block_hash] = height
+                offset += RECORD_HEADER.size + length
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def __contains__(self, block_hash: bytes) -> bool:
+        return block_hash in self._heights
+
+    def height_of(self, block_hash: bytes) -> int:
+        return self._heights.get(block_hash)
+
+    def append(self, height: int, block_hash: bytes, payload: bytes):
+        with self._lock:
+            if height != len(self._locations):
+                raise ValueError(f"Expected block at height {len(self._locations)}, got {height}")
+
+            if self._file.tell() > 0 and self._file.tell() + RECORD_HEADER.size + len(payload) > self.segment_max_size:
+                self._sync()
+                self._file.close()
+                self._segment += 1
+                self._file = open(self._segment_path(self._segment), "ab")
+
+            offset = self._file.tell()
+            self._file.write(RECORD_HEADER.pack(RECORD_MAGIC, len(payload), height, block_hash, zlib.crc32(payload)))
+            self._file.write(payload)
+
+            self._locations.append((self._segment, offset + RECORD_HEADER.size, len(payload)))
+            self._heights[block_hash] = height
+
+            self._unsynced += 1
+            if self._unsynced >= self.sync_interval:
+                self._sync()
+
+    def truncate(self, height: int):
+        # Drops the blocks at `height` and above (used when disconnecting blocks)
+        with self._lock:
+            if height >= len(self._locations):
+                return
+
+            segment, offset, _ = self._locations[height]
+
+            self._sync()
+            self._file.close()
+            self._maps.clear()
+
+            with open(self._segment_path(segment), "r+b") as f:
+                f.truncate(offset - RECORD_HEADER.size)
+                f.flush()
+                os.fsync(f.fileno())
+
+            later = segment + 1
+            while os.path.exists(self._segment_path(later)):
+                os.remove(self._segment_path(later))
+                later += 1
+
+            self._heights = {h: i for h, i in self._heights.items() if i < height}
+            del self._locations[height:]
+
+            self._segment = segment
+            self._file = open(self._segment_path(segment), "ab")
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        m = self._maps.get(segment)
+
+        if m is None or len(m) < end:
+            if segment == self._segment:
+                self._file.flush()
+
+            # An old, smaller map may still back views handed out earlier, so it
+            # is left for the garbage collector instead of being closed here
+            with open(self._segment_path(segment), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            self._maps[segment] = m
+
+        return m
+
+    def read(self, height: int) -> memoryview:
+        # Returns a view into the mapped segment file; nothing is copied. The
+        # view is only safe until truncate() shrinks the file (touching a cut off
+        # page kills the process), so use parse() if another thread may truncate.
+        with self._lock:
+            segment, offset, length = self._locations[height]
+            return memoryview(self._map(segment, offset + length))[offset:offset + length]
+
+    def parse(self, height: int, parser):
+        # Returns parser(view of the record), run under the store lock so the
+        # file can't be truncated while it is read. The result must not keep the view.
+        with self._lock:
+            return parser(self.read(height))
+
+    def read_by_hash(self, block_hash: bytes) -> memoryview:
+        height = self._heights.get(block_hash)
+
+        if height is None:
+            raise KeyError("Unknown block hash")
+
+        return self.read(height)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+            self._maps.clear()
+
+################################################################
+# OPTIONAL SECONDARY INDEXES
+################################################################
+
+class _SQLiteIndex:
+    # Both indexes keep the height of the last indexed block in a meta table so
+    # a node can tell whether the index has to catch up with (or roll back to)
+    # the block store on start-up.
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+            self._create_tables()
+
+    def _create_tables(self):
+        raise NotImplementedError
+
+    def _delete_block(self, height: int):
+        raise NotImplementedError
+
+    def height(self) -> int:
+        # Number of indexed blocks
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'height'").fetchone()
+        return 0 if row is None else row[0]
+
+    def _set_height(self, height: int):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('height', ?)", (height,))
+
+    def remove_block(self, height: int):
+        with self._lock, self._db:
+            self._delete_block(height)
+            self._set_height(min(self.height(), height))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class TxIndex(_SQLiteIndex):
+    # tx hash -> (block height, position in block)
+    def _create_tables(self):
+        self._db.execute("CREATE TABLE IF NOT EXISTS tx (hash BLOB PRIMARY KEY, height INTEGER, position INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tx_height ON tx (height)")
+
+    def _delete_block(self, height: int):
+        self._db.execute("DELETE FROM tx WHERE height = ?", (height,))
+
+    def add_block(self, height: int, tx_hashes: list):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tx (hash, height, position) VALUES (?, ?, ?)",
+                ((tx_hash, height, position) for position, tx_hash in enumerate(tx_hashes))
+            )
+            self._set_height(height + 1)
+
+    def get(self, tx_hash: bytes) -> tuple:
+        with self._lock:
+            return self._db.execute("SELECT height, position FROM tx WHERE hash = ?", (tx_hash,)).fetchone()
+
+class AddressIndex(_SQLiteIndex):
+    # address -> [(block height, position in block), ...]
+    def _create_tables(self):
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS address_tx (address TEXT, height INTEGER, position INTEGER, " +
+            "PRIMARY KEY (address, height, position))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS address_tx_height ON address_tx (height)")
+
+    def _delete_block(self, height: int):
+        self._db.execute("DELETE FROM address_tx WHERE height = ?", (height,))
+
+    def add_block(self, height: int, entries: list):
+        # entries: [(address, position), ...]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO address_tx (address, height, position) VALUES (?, ?, ?)",
+                ((address, height, position) for address, position in entries)
+            )
+            self._set_height(height + 1)
+
+    def history(self, address: str, offset: int = 0, limit: int = 100) -> list:
+        with self._lock:
+            return self._db.execute(
+                "SELECT height, position FROM address_tx WHERE address = ? ORDER BY height, position LIMIT ? OFFSET ?",
+                (address, limit, offset)
+            ).fetchall()
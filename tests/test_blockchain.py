@@ -0,0 +1,188 @@
+import pytest
+
+import blockchain
+from blockchain import Blockchain, PrivateKey, PublicKey, Transaction
+
+################################################################
+# HELPERS
+################################################################
+
+ALICE_KEY = PrivateKey(1234)
+ALICE = PublicKey(ALICE_KEY)
+BOB = PublicKey(PrivateKey(5678))
+
+@pytest.fixture
+def chain(monkeypatch):
+    monkeypatch.setattr(blockchain, "get_difficulty", lambda height: 1)
+
+    chain = Blockchain()
+    yield chain
+    chain.close()
+
+def _spend(amount: int, prev_hash: bytes, key: PrivateKey = ALICE_KEY, recipient: str = BOB.address) -> Transaction:
+    tx = Transaction(PublicKey(key), recipient, amount, prev_hash)
+    tx.sign(key)
+    return tx
+
+def _chained_spends(count: int, prev_hash: bytes = bytes(32)) -> list:
+    txs = []
+
+    for i in range(count):
+        txs.append(_spend(10 + i, prev_hash))
+        prev_hash = txs[-1].hash()
+
+    return txs
+
+def _snapshot(chain: Blockchain) -> tuple:
+    state = chain.state
+    addresses = (ALICE.address, BOB.address)
+
+    return (
+        len(chain.chain),
+        chain.chain.header(len(chain.chain) - 1).hash(),
+        [(state.balance(a), state.last_tx(a), state.last_sent(a)) for a in addresses]
+    )
+
+################################################################
+# SENDER CHAINING
+################################################################
+
+def test_first_spend_must_use_zero_prev_hash(chain):
+    chain.mine(ALICE.address)
+    coinbase_hash = chain.chain[-1].transactions[-1].hash()
+
+    assert chain.add_transactions([_spend(10, coinbase_hash)]) == [0]
+    assert chain.add_transactions([_spend(10, bytes(32))]) == []
+
+def test_next_spend_must_follow_last_one(chain):
+    chain.mine(ALICE.address)
+    first = _spend(10, bytes(32))
+    chain.add_transaction(first)
+    chain.mine(ALICE.address)
+
+    assert chain.state.last_sent(ALICE.address) == first.hash()
+    assert chain.add_transactions([_spend(11, bytes(32))]) == [0]
+    assert chain.add_transactions([_spend(11, first.hash())]) == []
+
+def test_out_of_order_batch_keeps_history_recoverable(chain):
+    chain.mine(ALICE.address)
+    txs = _chained_spends(3)
+
+    # Only the first spend can start the chain; the others are retried later
+    assert chain.add_transactions(list(reversed(txs))) == [0, 1]
+    assert list(chain.mempool.by_sender(ALICE.address)) == txs[:1]
+
+    assert chain.add_transactions(txs[1:]) == []
+    assert list(chain.mempool.by_sender(ALICE.address)) == txs
+
+    block = chain.mine(ALICE.address)
+    assert [tx.hash() for tx in block.transactions[:-1]] == [tx.hash() for tx in txs]
+    assert len(chain.mempool) == 0
+
+def test_confirmed_transaction_is_rejected(chain):
+    chain.mine(ALICE.address)
+    tx = _spend(10, bytes(32))
+    chain.add_transaction(tx)
+    chain.mine(ALICE.address)
+
+    assert chain.add_transactions([tx]) == [0]
+
+def test_block_with_unchained_first_spend_is_rejected(chain):
+    chain.mine(ALICE.address)
+    coinbase_hash = chain.chain[-1].transactions[-1].hash()
+
+    block = blockchain.Block(
+        height = len(chain.chain),
+        transactions = [_spend(10, coinbase_hash)],
+        prev_hash = chain.chain.headers[-1].hash()
+    )
+    block.mine(ALICE.address, coinbase_hash)
+
+    with pytest.raises(blockchain.ValidationError) as err:
+        chain.add_block(block)
+
+    assert err.value.stage == "state"
+
+################################################################
+# UNDO
+################################################################
+
+def test_disconnect_tip_restores_state(chain):
+    chain.mine(ALICE.address)
+    before = _snapshot(chain)
+
+    txs = _chained_spends(3)
+    chain.add_transactions(txs)
+    block = chain.mine(BOB.address)
+
+    assert chain.state.balance(BOB.address) > before[2][1][0]
+    assert chain.disconnect_tip() is block
+    assert _snapshot(chain) == before
+
+    # Its transactions are pending again and can be mined once more
+    assert list(chain.mempool.by_sender(ALICE.address)) == txs
+    chain.mine(BOB.address)
+    assert len(chain.mempool) == 0
+
+def test_disconnect_connect_round_trip(chain):
+    snapshots = []
+
+    for i in range(4):
+        chain.mine(ALICE.address)
+
+        if i > 0:
+            chain.add_transaction(_spend(5, chain.state.last_sent(ALICE.address)))
+
+        snapshots.append(_snapshot(chain))
+
+    blocks = []
+    while len(chain.chain) > 1:
+        assert _snapshot(chain) == snapshots[len(chain.chain) - 1]
+        blocks.append(chain.disconnect_tip())
+
+    assert _snapshot(chain) == snapshots[0]
+
+    assert chain.connect_blocks(1, list(reversed(blocks))) == len(blocks)
+    assert _snapshot(chain) == snapshots[-1]
+
+def test_failed_reorg_restores_old_branch(chain):
+    for _ in range(3):
+        chain.mine(ALICE.address)
+
+    before = _snapshot(chain)
+
+    bad = blockchain.Block(height = 1, transactions = [], prev_hash = bytes(32))
+    bad.mine(ALICE.address, bytes(32))
+
+    with pytest.raises(ValueError):
+        chain.connect_blocks(1, [bad])
+
+    assert _snapshot(chain) == before
+
+################################################################
+# MEMPOOL
+################################################################
+
+def test_full_mempool_keeps_ancestors_of_new_transaction(chain):
+    chain.mine(ALICE.address)
+    chain.mempool.max_transactions = 5
+    txs = _chained_spends(8)
+
+    failures = chain.add_transactions(txs)
+
+    assert failures == [5, 6, 7]
+    assert [tx.hash() for tx in chain.mempool.by_sender(ALICE.address)] == [tx.hash() for tx in txs[:5]]
+
+def test_full_mempool_reports_evicted_batch_members(chain):
+    chain.mine(ALICE.address)
+    chain.mine(BOB.address)
+    chain.mempool.max_transactions = 2
+
+    bob_key = PrivateKey(5678)
+    txs = _chained_spends(2) + [_spend(1, bytes(32), key=bob_key, recipient=ALICE.address)]
+
+    failures = chain.add_transactions(txs)
+
+    # Bob's spend evicted Alice's oldest one and, with it, its dependant
+    assert failures == [0, 1]
+    assert len(chain.mempool) == 1 and txs[2].hash() in chain.mempool
@@ -0,0 +1,158 @@
+import random
+
+import pytest
+
+import ecc
+from ecc import S256_G, S256_N, S256Field, S256Point, Point, PrivateKey, Signature
+
+################################################################
+# REFERENCE IMPLEMENTATION
+################################################################
+
+# Plain affine double-and-add from Point, without the Jacobian, table or GLV code
+def _reference_point(p: S256Point) -> Point:
+    if p.x is None:
+        return Point(None, None, S256Field(0), S256Field(7))
+
+    return Point(S256Field(p.x.num), S256Field(p.y.num), S256Field(0), S256Field(7))
+
+def _reference_multiply(k: int, p: S256Point) -> tuple:
+    q = Point.__rmul__(_reference_point(p), k % S256_N)
+
+    if q.x is None:
+        return (None, None)
+
+    return (q.x.num, q.y.num)
+
+def _coordinates(p: S256Point) -> tuple:
+    if p.x is None:
+        return (None, None)
+
+    return (p.x.num, p.y.num)
+
+def _reference_verify(point: S256Point, z: int, sig: Signature) -> bool:
+    if not (0 < sig.r < S256_N and 0 < sig.s < S256_N):
+        return False
+
+    s_inv = pow(sig.s, S256_N - 2, S256_N)
+    u = _reference_point(S256_G).__rmul__(z * s_inv % S256_N)
+    v = _reference_point(point).__rmul__(sig.r * s_inv % S256_N)
+    r = u + v
+
+    return r.x is not None and r.x.num == sig.r
+
+################################################################
+# SCALAR MULTIPLICATION
+################################################################
+
+EDGE_SCALARS = [
+    0,
+    1,
+    2,
+    S256_N - 1,
+    S256_N,
+    S256_N + 1,
+    ecc._GLV_LAMBDA,
+    ecc._GLV_LAMBDA - 1,
+    ecc._GLV_LAMBDA + 1,
+    S256_N - ecc._GLV_LAMBDA,
+    2**128 - 1,
+    2**128,
+    2**128 + 1,
+    2**127,
+    2**129 - 1,
+    2**255,
+    2**256 - 1
+]
+
+rng = random.Random(4)
+RANDOM_SCALARS = [rng.randrange(S256_N) for _ in range(8)] + [rng.randrange(2**128) for _ in range(4)]
+
+POINTS = [
+    S256_G,                                  # fixed-base table path
+    12345 * S256_G,                          # GLV path
+    rng.randrange(1, S256_N) * S256_G
+]
+
+@pytest.mark.parametrize("p", POINTS)
+@pytest.mark.parametrize("k", EDGE_SCALARS + RANDOM_SCALARS)
+def test_multiply_matches_reference(p, k):
+    assert _coordinates(k * p) == _reference_multiply(k, p)
+
+@pytest.mark.parametrize("k", EDGE_SCALARS + RANDOM_SCALARS)
+def test_glv_split(k):
+    k %= S256_N
+    k1, k2 = ecc._glv_split(k)
+
+    assert (k1 + k2 * ecc._GLV_LAMBDA) % S256_N == k
+    assert abs(k1) < 2**129 and abs(k2) < 2**129
+
+def test_endomorphism():
+    # lambda * P == (beta * x, y)
+    p = POINTS[2]
+    q = ecc._GLV_LAMBDA * p
+
+    assert q.x.num == ecc._GLV_BETA * p.x.num % ecc.S256_PRIME
+    assert q.y.num == p.y.num
+
+def test_add_matches_reference():
+    p, q = POINTS[1], POINTS[2]
+    r = _reference_point(p) + _reference_point(q)
+
+    assert _coordinates(p + q) == (r.x.num, r.y.num)
+    assert _coordinates(p + p) == _reference_multiply(2, p)
+
+################################################################
+# SIGNATURES
+################################################################
+
+def _signed_items(count: int) -> list:
+    rng = random.Random(7)
+    items = []
+
+    for _ in range(count):
+        key = PrivateKey(rng.randrange(1, S256_N))
+        z = rng.randrange(2**256)
+        items.append((key.point, z, key.sign(z)))
+
+    return items
+
+def test_verify_valid():
+    for point, z, sig in _signed_items(4):
+        assert point.verify(z, sig)
+        assert _reference_verify(point, z, sig)
+
+def test_verify_invalid():
+    (point, z, sig), (other_point, _, _) = _signed_items(2)
+
+    bad = [
+        (point, z + 1, sig),
+        (other_point, z, sig),
+        (point, z, Signature(sig.r, S256_N - sig.s + 1)),
+        (point, z, Signature(sig.r + 1, sig.s)),
+        (point, z, Signature(0, sig.s)),
+        (point, z, Signature(sig.r, 0)),
+        (point, z, Signature(sig.r, S256_N))
+    ]
+
+    for p, z2, s in bad:
+        assert not p.verify(z2, s)
+        assert not _reference_verify(p, z2, s)
+
+def test_batch_verify():
+    items = _signed_items(6)
+    point, z, sig = items[0]
+
+    # Same key signing several messages shares tables inside batch_verify
+    items.append((point, z + 5, sig))
+    items.append((point, z, sig))
+
+    assert ecc.batch_verify(items[:6]) == []
+    assert ecc.batch_verify(items) == [6]
+    assert ecc.batch_verify([]) == []
+
+    mixed = list(items[:6])
+    mixed[1] = (mixed[1][0], mixed[1][1] ^ 1, mixed[1][2])
+    mixed[4] = (mixed[0][0], mixed[4][1], mixed[4][2])
+
+    assert ecc.batch_verify(mixed) == [1, 4]
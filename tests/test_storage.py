@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+import storage
+from storage import RECORD_HEADER, BlockStore
+
+################################################################
+# HELPERS
+################################################################
+
+def _payload(height: int) -> bytes:
+    return bytes([height % 251]) * (100 + height)
+
+def _hash(height: int) -> bytes:
+    return height.to_bytes(32, "big")
+
+def _write(directory: str, count: int, **kwargs) -> BlockStore:
+    store = BlockStore(directory, **kwargs)
+
+    for height in range(count):
+        store.append(height, _hash(height), _payload(height))
+
+    return store
+
+def _segments(directory: str) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith(".dat"))
+
+def _check_prefix(store: BlockStore, count: int):
+    assert len(store) == count
+
+    for height in range(count):
+        assert bytes(store.read(height)) == _payload(height)
+        assert store.height_of(_hash(height)) == height
+
+    assert _hash(count) not in store
+
+################################################################
+# RECOVERY
+################################################################
+
+def test_reopen_keeps_every_record(tmp_path):
+    _write(str(tmp_path), 10).close()
+
+    _check_prefix(BlockStore(str(tmp_path)), 10)
+
+@pytest.mark.parametrize("cut", [1, RECORD_HEADER.size - 1, RECORD_HEADER.size, RECORD_HEADER.size + 50])
+def test_torn_last_record_is_dropped(tmp_path, cut):
+    _write(str(tmp_path), 5).close()
+    path = os.path.join(str(tmp_path), _segments(str(tmp_path))[-1])
+    last_record = RECORD_HEADER.size + len(_payload(4))
+
+    # Leave only `cut` bytes of the last record
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - last_record + cut)
+
+    store = BlockStore(str(tmp_path))
+    _check_prefix(store, 4)
+    assert os.path.getsize(path) == sum(RECORD_HEADER.size + len(_payload(h)) for h in range(4))
+
+    # Appending continues right after the intact prefix
+    store.append(4, _hash(4), _payload(4))
+    store.close()
+    _check_prefix(BlockStore(str(tmp_path)), 5)
+
+def test_garbage_after_last_record_is_dropped(tmp_path):
+    _write(str(tmp_path), 3).close()
+    path = os.path.join(str(tmp_path), _segments(str(tmp_path))[-1])
+
+    with open(path, "ab") as f:
+        f.write(storage.RECORD_MAGIC + b"\x00\x00\x01\x00garbage")
+
+    _check_prefix(BlockStore(str(tmp_path)), 3)
+
+def test_corrupted_last_payload_is_dropped(tmp_path):
+    _write(str(tmp_path), 4).close()
+    path = os.path.join(str(tmp_path), _segments(str(tmp_path))[-1])
+
+    with open(path, "r+b") as f:
+        f.seek(-10, os.SEEK_END)
+        f.write(b"\xff" * 5)
+
+    _check_prefix(BlockStore(str(tmp_path)), 3)
+
+def test_broken_earlier_segment_drops_later_ones(tmp_path):
+    _write(str(tmp_path), 12, segment_max_size=500).close()
+    segments = _segments(str(tmp_path))
+    assert len(segments) > 2
+
+    # Break the first record header of the second segment
+    with open(os.path.join(str(tmp_path), segments[1]), "r+b") as f:
+        f.write(b"XXXX")
+
+    store = BlockStore(str(tmp_path), segment_max_size=500)
+    count = len(store)
+
+    assert 0 < count < 12
+    _check_prefix(store, count)
+    assert _segments(str(tmp_path)) == segments[:2]
+
+def test_truncate_survives_reopen(tmp_path):
+    store = _write(str(tmp_path), 12, segment_max_size=500)
+    store.truncate(5)
+    _check_prefix(store, 5)
+
+    store.append(5, _hash(5), _payload(5))
+    store.close()
+    _check_prefix(BlockStore(str(tmp_path), segment_max_size=500), 6)
+
+################################################################
+# SYNCING
+################################################################
+
+def test_fsync_is_batched(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: (synced.append(fd), fsync(fd)))
+
+    store = _write(str(tmp_path), 10, sync_interval=4)
+    assert len(synced) == 2
+
+    store.close()
+    assert len(synced) == 3
+    _check_prefix(BlockStore(str(tmp_path)), 10)